@@ -1,18 +1,68 @@
 import logging
 import json
 import os
-from datetime import datetime
+import re
+import secrets
+import sqlite3
+import time
+from array import array
+from bisect import bisect_left
+from collections import deque
+from datetime import datetime, timedelta
 import pandas as pd
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler, filters, ContextTypes, ChatMemberHandler
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler, filters, ContextTypes, ChatMemberHandler, BaseRateLimiter, BaseUpdateProcessor, TypeHandler
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter
 import asyncio
+import contextlib
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
 # Constants
 BOT_TOKEN = "Your-Token"  # your telegram bot api token
 ADMIN_ID = "Your-User-Id" # your user id
 CHANNEL_USERNAME = "@Your-Channel" # your channel id
 CHANNEL_ID = -"Your-Channel-iD" # your channel id number
+BOT_STATUS_CACHE_TTL = 1800 # seconds; how long the bot's own status in a group is trusted without asking Telegram
+CHANNEL_MEMBER_CACHE_TTL = 3600 # seconds a confirmed channel membership is trusted
+CHANNEL_NON_MEMBER_CACHE_TTL = 15 # seconds a "not a member" answer is reused (users retry right after joining)
+GROUP_REFRESH_CONCURRENCY = 8 # get_chat calls in flight at once while refreshing group titles
+GROUP_REFRESH_TIMEOUT = 10 # seconds of HTTP connect/read time before a single get_chat is given up
+GROUP_METADATA_MAX_AGE = 900 # seconds; admin views older than this start a background group refresh
+BROADCAST_CONCURRENCY = 10 # messages of one broadcast in flight at once
+OUTBOUND_GLOBAL_RATE = 25 # Bot API requests per second across the whole bot (Telegram allows about 30 messages)
+OUTBOUND_PRIVATE_CHAT_RATE = 1 # messages per second to one private chat
+OUTBOUND_GROUP_CHAT_RATE = 20 / 60 # messages per second to one group (Telegram allows 20 per minute)
+OUTBOUND_CHAT_BURST = 3 # messages a chat may receive back to back before its rate applies
+OUTBOUND_MAX_RETRIES = 3 # RetryAfter retries of one request before the error reaches the caller
+JOIN_BATCH_MAX_SIZE = 500 # join/leave events applied in one batch (one transaction, one commit)
+JOIN_BATCH_MAX_DELAY = 0.2 # seconds the first event of a batch may wait for more to arrive
+JOIN_QUEUE_LIMIT = 20000 # queued join/leave events before track_new_member waits for the pipeline to catch up
+LEADERBOARD_SIZE = 10 # rows in the users' leaderboard (admins see twice as many)
+LEADERBOARD_WINDOWS = {"day": 24 * 3600, "week": 7 * 24 * 3600, "month": 30 * 24 * 3600} # rolling windows in seconds
+FRAUD_MODE = "flag" # "off", "flag" (award and alert admins) or "hold" (keep the award until an admin releases it)
+FRAUD_WINDOW = 3600 # seconds of join/leave history kept per adder and per group
+FRAUD_QUICK_LEAVE_SECONDS = 600 # a member who leaves within this many seconds of being added counts as a quick leave (<= FRAUD_WINDOW)
+FRAUD_MAX_JOINS_PER_ADDER = 150 # members one user may add within FRAUD_WINDOW
+FRAUD_MAX_JOINS_PER_GROUP = 1000 # members a single group may receive within FRAUD_WINDOW
+FRAUD_MIN_SAMPLE = 20 # joins needed before the ratios below are judged
+FRAUD_MAX_QUICK_LEAVE_RATIO = 0.5 # share of added members who left quickly
+FRAUD_MAX_BOTLIKE_RATIO = 0.5 # share of added members with throwaway-looking usernames
+FRAUD_BOTLIKE_USERNAME = re.compile(r"^(?:user_?\d+|[a-z]{1,12}_?\d{5,}|[a-z]{2,6}\d{2,}[a-z]{2,6}\d{2,})$", re.IGNORECASE)
+UPDATE_CONCURRENCY = 32 # updates handled at once; updates of the same user or chat always run one after another
+UPDATE_MAX_PENDING = 4096 # updates admitted at once, including those waiting behind an earlier update of their user/chat
+ADMIN_PROFILE_CACHE_TTL = 3600 # seconds an admin's name/username is shown without asking Telegram again
+ADMIN_DIGEST_WINDOW = 0 # seconds; >0 sends the first event of a kind at once and sums up the rest of the window in one message
+BROADCAST_PROGRESS_INTERVAL = 5 # seconds between edits of the broadcast status message
+RUN_MODE = "polling" # "polling" (getUpdates long-polling) or "webhook" (Telegram POSTs updates to the built-in listener)
+WEBHOOK_URL = "https://your-domain.example/telegram" # public HTTPS address registered with Telegram; its path must match WEBHOOK_PATH
+WEBHOOK_LISTEN = "0.0.0.0" # interface the webhook listener binds to
+WEBHOOK_PORT = 8443 # port the webhook listener binds to (put a TLS-terminating proxy in front of it)
+WEBHOOK_PATH = "telegram" # URL path the listener accepts updates on
+WEBHOOK_SECRET_TOKEN = "" # sent by Telegram in X-Telegram-Bot-Api-Secret-Token; requests without it are rejected. Empty = random per run
+WEBHOOK_MAX_CONNECTIONS = 40 # simultaneous HTTPS connections Telegram may open to deliver updates (1-100)
 
 # Conversation states
 (WAITING_PHONE, WAITING_NAME, WAITING_CARD, WAITING_SHEBA,
@@ -27,22 +77,677 @@ CHANNEL_ID = -"Your-Channel-iD" # your channel id number
 # Database directory
 DB_DIR = "bot_database"
 DB_FILE = os.path.join(DB_DIR, "main_data.json")
+SQLITE_DB_FILE = os.path.join(DB_DIR, "main_data.sqlite3")
+STORAGE_ENGINE = "json" # "json" (one file per collection) or "sqlite" (indexed tables, WAL mode)
+DB_COLLECTIONS = ("users", "groups", "unique_members", "points_ledger", "held_awards", "codes", "settlements", "support_tickets", "broadcasts")
+DB_META = "meta" # Every other top-level key (admins, promotional_links, next_code_id, ...)
+DB_FLUSH_INTERVAL = 5 # seconds between write-behind flushes of the resident database
+DB_JOURNAL_ENABLED = False # json engine: append hot-path mutations to a journal instead of rewriting the snapshot
+DB_JOURNAL_FILE = os.path.join(DB_DIR, "main_data.journal")
+DB_JOURNAL_COMPACT_INTERVAL = 600 # seconds; the journal is folded into a new snapshot at least this often
+DB_JOURNAL_COMPACT_BYTES = 4 * 1024 * 1024 # ...or as soon as it grows past this size
+DB_GROUP_COMMIT_WINDOW = 0.05 # seconds; writes requested within this window share one physical write/fsync
+
+# Resident database: loaded once, mutated in place by handlers and flushed by the write-behind job
+_db_state = {
+    "data": None, "dirty": set(), "dirty_keys": {}, "write_behind": False, "storage": None,
+    "journal": None, "journal_bytes": 0, "journal_since": None, "journal_keys": {},
+    "flush_in_flight": None, "flush_follow_up": None, "flush_compact": False,
+    "group_commit": None, "settlement_index": None, "stats": None, "leaderboard": None
+}
+
+def _empty_db():
+    return {
+        "users": {}, "groups": {}, "unique_members": UniqueMemberIndex(), "points_ledger": PointsLedger(), "held_awards": {}, "codes": {},
+        "settlements": {}, "support_tickets": {}, "broadcasts": {}, "admins": [ADMIN_ID],
+        "promotional_links": [f"https://t.me/{CHANNEL_USERNAME[1:]}"],
+        "next_code_id": 1, "next_ticket_id": 1, "next_broadcast_id": 1
+    }
+
+# --- Unique Members Index ---
+class UniqueMemberIndex:
+    """Compact replacement for the unique_members dict (member ID -> first-add attribution).
+
+    Member IDs live in a sorted int64 array and the attribution fields in parallel columns,
+    with group titles and adder usernames interned in a shared string table, so a member costs
+    a few dozen bytes instead of a dict of strings. New members go to a small pending dict that
+    is merged into the arrays in batches; lookups are a dict hit or a binary search.
+    get() and items() still return rows in the old dict format for the journal and SQLite.
+    """
+    MERGE_THRESHOLD = 4096
+    NO_USERNAME = "ندارد"
+
+    def __init__(self):
+        self._ids = array('q')
+        self._added_by = array('q')
+        self._added_at = array('q') # Unix seconds, 0 when unknown
+        self._group_ids = array('q')
+        self._title_refs = array('i') # -> self._strings
+        self._adder_username_refs = array('i') # -> self._strings
+        self._usernames = [] # None when the member has no username
+        self._strings = []
+        self._string_refs = {}
+        self._pending = {} # member ID -> column values, not yet merged into the arrays
+
+    @staticmethod
+    def _key(member_id):
+        try:
+            return int(member_id)
+        except (TypeError, ValueError):
+            return None
+
+    def _position(self, key):
+        i = bisect_left(self._ids, key)
+        return i if i < len(self._ids) and self._ids[i] == key else -1
+
+    def __contains__(self, member_id):
+        key = self._key(member_id)
+        return key is not None and (key in self._pending or self._position(key) >= 0)
+
+    def __len__(self):
+        return len(self._ids) + len(self._pending)
+
+    def _intern(self, value):
+        ref = self._string_refs.get(value)
+        if ref is None:
+            ref = self._string_refs[value] = len(self._strings)
+            self._strings.append(value)
+        return ref
+
+    def add(self, member_id, row):
+        # row uses the legacy field names (first_added_by, first_added_date, first_group_id, ...)
+        key = self._key(member_id)
+        if key is None: # Would poison the int64 id column at the next merge
+            raise ValueError(f"UniqueMemberIndex: member ID {member_id!r} is not an integer")
+        if key in self:
+            self.pop(key)
+        self._pending[key] = self._values(row)
+        if len(self._pending) >= self.MERGE_THRESHOLD:
+            self._merge_pending()
+
+    def _values(self, row):
+        try:
+            added_at = int(datetime.fromisoformat(row.get("first_added_date")).timestamp())
+        except (TypeError, ValueError):
+            added_at = 0
+        username = row.get("new_member_username")
+        return (
+            int(row.get("first_added_by") or 0), added_at, int(row.get("first_group_id") or 0),
+            self._intern(row.get("first_group_title") or ""),
+            self._intern(row.get("added_by_username") or self.NO_USERNAME),
+            None if username in (None, self.NO_USERNAME) else username,
+        )
+
+    __setitem__ = add
+
+    def get(self, member_id, default=None):
+        key = self._key(member_id)
+        if key is None:
+            return default
+        values = self._pending.get(key)
+        if values is None:
+            i = self._position(key)
+            if i < 0:
+                return default
+            values = (self._added_by[i], self._added_at[i], self._group_ids[i],
+                      self._title_refs[i], self._adder_username_refs[i], self._usernames[i])
+        added_by, added_at, group_id, title_ref, adder_username_ref, username = values
+        return {
+            "first_added_by": added_by,
+            "first_added_date": datetime.fromtimestamp(added_at).isoformat() if added_at else None,
+            "first_group_id": str(group_id),
+            "first_group_title": self._strings[title_ref],
+            "added_by_username": self._strings[adder_username_ref],
+            "new_member_username": username or self.NO_USERNAME
+        }
+
+    def __getitem__(self, member_id):
+        row = self.get(member_id)
+        if row is None:
+            raise KeyError(member_id)
+        return row
+
+    def pop(self, member_id, default=None):
+        row = self.get(member_id)
+        if row is None:
+            return default
+        key = self._key(member_id)
+        if self._pending.pop(key, None) is None:
+            i = self._position(key)
+            for column in self._columns():
+                del column[i]
+        return row
+
+    def items(self):
+        self._merge_pending()
+        for member_id in self._ids:
+            yield str(member_id), self.get(member_id)
+
+    def _columns(self):
+        return (self._ids, self._added_by, self._added_at, self._group_ids,
+                self._title_refs, self._adder_username_refs, self._usernames)
+
+    def _merge_pending(self):
+        if not self._pending:
+            return
+        pending = sorted(self._pending.items())
+        positions = [bisect_left(self._ids, key) for key, _ in pending]
+        merged = []
+        for field, column in enumerate(self._columns()):
+            # Copying whole slices between the insert points keeps the merge at C speed
+            new_column = array(column.typecode) if isinstance(column, array) else []
+            start = 0
+            for position, (key, values) in zip(positions, pending):
+                new_column.extend(column[start:position])
+                new_column.append(key if field == 0 else values[field - 1])
+                start = position
+            new_column.extend(column[start:])
+            merged.append(new_column)
+        (self._ids, self._added_by, self._added_at, self._group_ids,
+         self._title_refs, self._adder_username_refs, self._usernames) = merged
+        self._pending = {}
+
+    def copy(self):
+        # Cheap point-in-time copy (array memcpy) for the write-behind snapshot
+        clone = UniqueMemberIndex()
+        (clone._ids, clone._added_by, clone._added_at, clone._group_ids,
+         clone._title_refs, clone._adder_username_refs) = (array(c.typecode, c) for c in self._columns()[:6])
+        clone._usernames = list(self._usernames)
+        clone._strings = list(self._strings)
+        clone._string_refs = dict(self._string_refs)
+        clone._pending = dict(self._pending)
+        return clone
+
+    def to_json(self):
+        self._merge_pending()
+        return {
+            "format": "columnar",
+            "ids": self._ids.tolist(), "added_by": self._added_by.tolist(), "added_at": self._added_at.tolist(),
+            "group_ids": self._group_ids.tolist(), "title_refs": self._title_refs.tolist(),
+            "adder_username_refs": self._adder_username_refs.tolist(), "usernames": self._usernames,
+            "strings": self._strings
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        # Accepts the columnar format, the legacy {member_id: row} dict, or None
+        if isinstance(data, cls):
+            return data
+        index = cls()
+        if not data:
+            return index
+        if data.get("format") != "columnar":
+            for member_id, row in data.items():
+                if index._key(member_id) is not None:
+                    index._pending[index._key(member_id)] = index._values(row)
+            index._merge_pending() # One merge instead of one per MERGE_THRESHOLD rows
+            return index
+        index._ids = array('q', data["ids"])
+        index._added_by = array('q', data["added_by"])
+        index._added_at = array('q', data["added_at"])
+        index._group_ids = array('q', data["group_ids"])
+        index._title_refs = array('i', data["title_refs"])
+        index._adder_username_refs = array('i', data["adder_username_refs"])
+        index._usernames = list(data["usernames"])
+        index._strings = list(data["strings"])
+        index._string_refs = {value: ref for ref, value in enumerate(index._strings)}
+        return index
+
+# --- End of Unique Members Index ---
+
+# --- Points Ledger ---
+class PointsLedger:
+    """Append-only record of every point award: (adder, member, group, timestamp, delta).
+
+    Entries live in parallel int64 columns and never change once written. Entry N is journaled and
+    stored under key N, so replaying an entry that is already present is a no-op. Balances are
+    derived: updated on every append and rebuilt in one pass by recompute(). Points earned before
+    the ledger existed are carried by opening-balance entries (member 0, group 0).
+    """
+
+    def __init__(self):
+        self._adders = array('q')
+        self._members = array('q')
+        self._groups = array('q')
+        self._timestamps = array('q') # Unix seconds
+        self._deltas = array('q')
+        self._balances = {} # adder ID -> sum of deltas
+
+    def __len__(self):
+        return len(self._adders)
+
+    def append(self, adder_id, member_id, group_id, delta, timestamp=None):
+        adder_id = int(adder_id)
+        self._adders.append(adder_id)
+        self._members.append(int(member_id))
+        self._groups.append(int(group_id))
+        self._timestamps.append(int(timestamp if timestamp is not None else time.time()))
+        self._deltas.append(int(delta))
+        self._balances[adder_id] = self._balances.get(adder_id, 0) + int(delta)
+        return len(self) - 1
+
+    def get(self, seq, default=None):
+        seq = int(seq)
+        if not 0 <= seq < len(self):
+            return default
+        return {
+            "adder_id": self._adders[seq], "member_id": self._members[seq], "group_id": self._groups[seq],
+            "timestamp": self._timestamps[seq], "delta": self._deltas[seq]
+        }
+
+    def entry(self, seq):
+        # (adder, member, group, timestamp, delta) without building a row dict
+        return (self._adders[seq], self._members[seq], self._groups[seq], self._timestamps[seq], self._deltas[seq])
+
+    def __setitem__(self, seq, row):
+        # Journal replay and SQLite rows; entries are immutable, so a known seq is already applied
+        if int(seq) < len(self):
+            return
+        self.append(row["adder_id"], row["member_id"], row["group_id"], row["delta"], row["timestamp"])
+
+    def items(self):
+        for seq in range(len(self)):
+            yield str(seq), self.get(seq)
+
+    def balance(self, user_id):
+        return self._balances.get(int(user_id), 0)
+
+    def recompute(self):
+        balances = {}
+        for adder_id, delta in zip(self._adders, self._deltas):
+            balances[adder_id] = balances.get(adder_id, 0) + delta
+        self._balances = balances
+        return balances
+
+    def _columns(self):
+        return (self._adders, self._members, self._groups, self._timestamps, self._deltas)
+
+    def copy(self):
+        clone = PointsLedger()
+        (clone._adders, clone._members, clone._groups, clone._timestamps, clone._deltas) = (array(c.typecode, c) for c in self._columns())
+        clone._balances = dict(self._balances)
+        return clone
+
+    def to_json(self):
+        return {
+            "format": "columnar",
+            "adders": self._adders.tolist(), "members": self._members.tolist(), "groups": self._groups.tolist(),
+            "timestamps": self._timestamps.tolist(), "deltas": self._deltas.tolist()
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        # Accepts the columnar format, {seq: row} rows (SQLite), or None
+        if isinstance(data, cls):
+            return data
+        ledger = cls()
+        if not data:
+            return ledger
+        if data.get("format") != "columnar":
+            for seq in sorted(data, key=int):
+                ledger[len(ledger)] = data[seq]
+            return ledger
+        ledger._adders = array('q', data["adders"])
+        ledger._members = array('q', data["members"])
+        ledger._groups = array('q', data["groups"])
+        ledger._timestamps = array('q', data["timestamps"])
+        ledger._deltas = array('q', data["deltas"])
+        ledger.recompute()
+        return ledger
+
+def issue_due_codes(db, user_id_str):
+    # One code per 100 points of balance; returns [(code_id, milestone)] for the codes issued now
+    user_data = db["users"][user_id_str]
+    codes = user_data.setdefault("codes", [])
+    issued = []
+    while len(codes) < user_data.get("points", 0) // 100:
+        new_code_id = db.get("next_code_id", 1)
+        db["next_code_id"] = new_code_id + 1
+        db.setdefault("codes", {})[str(new_code_id)] = {
+            "user_id": int(user_id_str), "date": datetime.now().isoformat(), "settled": False
+        }
+        codes.append(new_code_id)
+        issued.append((new_code_id, len(codes) * 100))
+    return issued
+
+def reconcile_points(db, recompute=False):
+    """Makes users[id]["points"] and the issued codes match the ledger; returns (drifted users, codes issued).
+
+    An empty ledger next to users with points means the data predates the ledger: their points
+    become opening-balance entries. recompute=True rebuilds the balances from the entries first.
+    Owners of codes issued here are notified through the user notification queue, like codes
+    issued by the join pipeline.
+    """
+    ledger = db["points_ledger"]
+    if not len(ledger):
+        for user_id_str, user_data in db.get("users", {}).items():
+            if user_data.get("points", 0):
+                ledger.append(user_id_str, 0, 0, user_data["points"])
+        if len(ledger):
+            mark_dirty("points_ledger")
+            logging.info(f"reconcile_points: Recorded opening balances for {len(ledger)} users in the points ledger.")
+    elif recompute:
+        ledger.recompute()
+    drifted, issued = [], []
+    for user_id_str, user_data in db.get("users", {}).items():
+        balance = ledger.balance(user_id_str)
+        touched = False
+        if user_data.get("points", 0) != balance:
+            logging.warning(f"reconcile_points: User {user_id_str} had {user_data.get('points', 0)} points but the ledger says {balance}. Corrected.")
+            user_data["points"] = balance
+            drifted.append(user_id_str)
+            touched = True
+        user_issued = issue_due_codes(db, user_id_str)
+        if touched or user_issued:
+            mark_dirty(("users", user_id_str), *(("codes", str(code_id)) for code_id, _ in user_issued))
+        for code_id, milestone in user_issued:
+            # At load time this waits in the queue until post_init starts the notification worker
+            queue_code_notification(user_id_str, code_id, milestone)
+        issued.extend(user_issued)
+    if issued:
+        mark_dirty((DB_META, "next_code_id"))
+    return drifted, issued
+
+# --- End of Points Ledger ---
+
+# --- Storage Engines ---
+def hydrate_db(db):
+    # Turns the loaded JSON into the in-memory layout: the unique_members index and integer roster sets
+    db["unique_members"] = UniqueMemberIndex.from_json(db.get("unique_members"))
+    db["points_ledger"] = PointsLedger.from_json(db.get("points_ledger"))
+    for group_data in db.get("groups", {}).values():
+        group_data["members"] = to_member_set(group_data.get("members"))
+    return db
+
+def to_member_set(members):
+    # Rosters used to be lists of string IDs; they are now sets of ints, stored as sorted lists
+    return {int(member_id) for member_id in members or ()}
+
+def json_default(value):
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def atomic_write_json(path, data, **dump_kwargs):
+    atomic_write(path, lambda f: json.dump(data, f, **dump_kwargs))
+
+def atomic_write(path, write):
+    # temp file + fsync + rename: readers and crashes only ever see the old or the new file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    try:
+        dir_fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+        try:
+            os.fsync(dir_fd) # Persist the rename itself
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass # Directory fsync is not supported on every platform
+
+class JsonStorage:
+    """Stores each collection in its own JSON file (users.json, codes.json, ...) plus meta.json.
+
+    save() receives only the collections that changed, so e.g. a ticket reply rewrites
+    support_tickets.json and nothing else. Changed rows arrive on their own: the storage keeps
+    every row of a shard already encoded as JSON, re-encodes just those rows and joins the file
+    back together on the db-io thread, so the event loop only ever copies the rows that changed.
+    The columnar collections are always written whole. A legacy single-file main_data.json is
+    split on first load.
+    """
+    name = "json"
+    WHOLE_COLLECTIONS = frozenset({"unique_members", "points_ledger"})
+
+    def __init__(self):
+        self._encoded = {} # collection -> {key: encoded row}, as last written to the shard (db-io thread only)
+
+    def shard_path(self, collection):
+        return os.path.join(DB_DIR, f"{collection}.json")
+
+    def exists(self):
+        return os.path.exists(self.shard_path(DB_META)) or os.path.exists(DB_FILE)
+
+    def load(self):
+        if not os.path.exists(self.shard_path(DB_META)):
+            return self._split_legacy_file()
+        shards = (*DB_COLLECTIONS, DB_META)
+        with ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix="db-load") as pool:
+            loaded = dict(zip(shards, pool.map(self._load_shard, shards)))
+        db = loaded.pop(DB_META)
+        if db is None: # Counters and admin list are lost; rebuild what we can
+            db = _empty_db()
+            db["next_code_id"] = max((int(k) for k in (loaded["codes"] or {})), default=0) + 1
+            db["next_ticket_id"] = max((int(k) for k in (loaded["support_tickets"] or {})), default=0) + 1
+            db["next_broadcast_id"] = max((int(k) for k in (loaded["broadcasts"] or {})), default=0) + 1
+        for collection, rows in loaded.items():
+            db[collection] = rows if rows is not None else {}
+        return hydrate_db(db)
+
+    def _load_shard(self, collection):
+        path = self.shard_path(collection)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError:
+            logging.error(f"Error decoding JSON from {path}. File might be corrupted. Creating a backup and starting this collection fresh.")
+            backup_file = f"{path}_corrupted_{datetime.now().strftime('%Y%m%d%H%M%S')}.json"
+            os.rename(path, backup_file)
+            logging.info(f"Corrupted shard backed up to {backup_file}")
+            return None
+
+    def _split_legacy_file(self):
+        try:
+            with open(DB_FILE, 'r', encoding='utf-8') as f:
+                db = json.load(f)
+        except FileNotFoundError:
+            logging.warning(f"Database files not found in {DB_DIR}. Initializing a new database.")
+            return None
+        except json.JSONDecodeError:
+            logging.error(f"Error decoding JSON from {DB_FILE}. File might be corrupted. Creating a backup and starting fresh.")
+            backup_file = f"{DB_FILE}_corrupted_{datetime.now().strftime('%Y%m%d%H%M%S')}.json"
+            os.rename(DB_FILE, backup_file)
+            logging.info(f"Corrupted DB backed up to {backup_file}")
+            return None
+        hydrate_db(db)
+        self.save(split_db(db))
+        migrated_file = f"{DB_FILE}_migrated_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        os.rename(DB_FILE, migrated_file)
+        logging.info(f"Split {DB_FILE} into per-collection files. The original was kept as {migrated_file}.")
+        return db
+
+    def save(self, parts, rows=None):
+        # parts: collection -> all of its rows (see split_db); rows: collection -> {key: row, or None
+        # when the key was deleted}. Collections first and meta last, so a present meta.json means a
+        # complete set of shards.
+        rows = rows or {}
+        for collection in sorted({*parts, *rows}, key=lambda c: c == DB_META):
+            data = parts.get(collection)
+            if isinstance(data, (UniqueMemberIndex, PointsLedger)):
+                atomic_write_json(self.shard_path(collection), data.to_json(), ensure_ascii=False, default=json_default)
+                continue
+            if data is not None:
+                encoded = self._encoded[collection] = {str(key): self._encode(row) for key, row in data.items()}
+            else:
+                encoded = self._encoded_shard(collection)
+            for key, row in rows.get(collection, {}).items():
+                if row is None:
+                    encoded.pop(key, None)
+                else:
+                    encoded[key] = self._encode(row)
+            atomic_write(self.shard_path(collection), lambda f: self._write_encoded(f, encoded))
+
+    def _encoded_shard(self, collection):
+        # The first row-level save of a shard since start-up encodes what is on disk
+        if collection not in self._encoded:
+            data = self._load_shard(collection) or {}
+            self._encoded[collection] = {str(key): self._encode(row) for key, row in data.items()}
+        return self._encoded[collection]
+
+    @staticmethod
+    def _encode(value):
+        return json.dumps(value, ensure_ascii=False, default=json_default)
+
+    def _write_encoded(self, f, encoded):
+        f.write("{")
+        for i, (key, row) in enumerate(encoded.items()):
+            f.write(f"{', ' if i else ''}{self._encode(key)}: {row}")
+        f.write("}")
+
+    def archive(self, suffix):
+        for collection in (*DB_COLLECTIONS, DB_META):
+            path = self.shard_path(collection)
+            if os.path.exists(path):
+                os.rename(path, f"{path}{suffix}")
+
+
+def split_db(db, collections=None):
+    # Maps collection name -> data for the requested collections (all by default), meta included
+    wanted = set(collections) if collections is not None else {*DB_COLLECTIONS, DB_META}
+    parts = {c: db.get(c, {}) for c in DB_COLLECTIONS if c in wanted}
+    if DB_META in wanted:
+        parts[DB_META] = {k: v for k, v in db.items() if k not in DB_COLLECTIONS}
+    return parts
+
+
+class SqliteStorage:
+    """Stores each collection in its own indexed table (WAL mode); other top-level keys live in `meta`.
+
+    Every row keeps its full JSON document in `data`; the remaining columns are extracted copies
+    that back the indexes. save() rewrites whole tables only when a whole collection was marked
+    dirty; otherwise it upserts or deletes just the keys recorded by mark_dirty().
+    """
+    name = "sqlite"
+    WHOLE_COLLECTIONS = frozenset() # Every table takes row-level upserts
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (key TEXT PRIMARY KEY, registered INTEGER, points INTEGER, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS groups (key TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS unique_members (key TEXT PRIMARY KEY, first_added_by INTEGER, first_group_id TEXT, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS points_ledger (key TEXT PRIMARY KEY, adder_id INTEGER, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS held_awards (key TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS codes (key TEXT PRIMARY KEY, user_id INTEGER, settled INTEGER, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS settlements (key TEXT PRIMARY KEY, user_id INTEGER, code_id TEXT, status TEXT, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS support_tickets (key TEXT PRIMARY KEY, user_id INTEGER, status TEXT, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS broadcasts (key TEXT PRIMARY KEY, status TEXT, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS idx_users_registered ON users (registered);
+        CREATE INDEX IF NOT EXISTS idx_unique_members_added_by ON unique_members (first_added_by);
+        CREATE INDEX IF NOT EXISTS idx_points_ledger_adder ON points_ledger (adder_id);
+        CREATE INDEX IF NOT EXISTS idx_codes_user ON codes (user_id, settled);
+        CREATE INDEX IF NOT EXISTS idx_settlements_user ON settlements (user_id);
+        CREATE INDEX IF NOT EXISTS idx_settlements_code_status ON settlements (code_id, status);
+        CREATE INDEX IF NOT EXISTS idx_settlements_status ON settlements (status);
+        CREATE INDEX IF NOT EXISTS idx_support_tickets_status ON support_tickets (status);
+    """
+    # table -> extractors for its indexed columns, in column order
+    COLUMNS = {
+        "users": {"registered": lambda r: int(bool(r.get("registered"))), "points": lambda r: r.get("points", 0)},
+        "groups": {},
+        "unique_members": {"first_added_by": lambda r: r.get("first_added_by"), "first_group_id": lambda r: r.get("first_group_id")},
+        "points_ledger": {"adder_id": lambda r: r.get("adder_id")},
+        "held_awards": {},
+        "codes": {"user_id": lambda r: r.get("user_id"), "settled": lambda r: int(bool(r.get("settled")))},
+        "settlements": {"user_id": lambda r: r.get("user_id"), "code_id": lambda r: str(r.get("code_id")), "status": lambda r: r.get("status")},
+        "support_tickets": {"user_id": lambda r: r.get("user_id"), "status": lambda r: r.get("status")},
+        "broadcasts": {"status": lambda r: r.get("status")},
+    }
+
+    def __init__(self, path=SQLITE_DB_FILE):
+        self.path = path
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    def exists(self):
+        if not os.path.exists(self.path):
+            return False
+        return self._connection().execute("SELECT 1 FROM meta LIMIT 1").fetchone() is not None
+
+    def load(self):
+        if not self.exists():
+            return None
+        conn = self._connection()
+        db = {}
+        for table in self.COLUMNS:
+            rows = db[table] = {}
+            for key, data in conn.execute(f"SELECT key, data FROM {table}"):
+                rows[key] = json.loads(data)
+        for key, data in conn.execute("SELECT key, data FROM meta"):
+            db[key] = json.loads(data)
+        return hydrate_db(db)
+
+    def save(self, parts, rows=None):
+        # parts: collection -> all of its rows (see split_db), rewritten as a whole.
+        # rows: collection -> {key: row, or None when the key was deleted}, written key by key.
+        conn = self._connection()
+        with conn: # One transaction per save
+            for table, data in parts.items():
+                conn.execute(f"DELETE FROM {table}")
+                for key, row in data.items():
+                    self._upsert(conn, table, str(key), row)
+            for table, changed in (rows or {}).items():
+                for key, row in changed.items():
+                    if row is None:
+                        conn.execute(f"DELETE FROM {table} WHERE key = ?", (str(key),))
+                    else:
+                        self._upsert(conn, table, str(key), row)
+
+    def _upsert(self, conn, table, key, row):
+        columns = self.COLUMNS.get(table, {})
+        column_list = ", ".join(["key", *columns, "data"])
+        placeholders = ", ".join("?" * (len(columns) + 2))
+        data = json.dumps(row, ensure_ascii=False, default=json_default)
+        conn.execute(f"INSERT OR REPLACE INTO {table} ({column_list}) VALUES ({placeholders})",
+                     (key, *[extract(row) for extract in columns.values()], data))
+
+
+def get_storage():
+    storage = _db_state["storage"]
+    if storage is None:
+        storage = SqliteStorage() if STORAGE_ENGINE == "sqlite" else JsonStorage()
+        _db_state["storage"] = storage
+    return storage
+
+def migrate_json_to_sqlite(sqlite_storage):
+    # One-shot import of the JSON database (single file or per-collection files) into an empty SQLite database
+    json_storage = JsonStorage()
+    json_db = json_storage.load()
+    if json_db is None:
+        return False
+    sqlite_storage.save(split_db(json_db))
+    suffix = f"_migrated_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    json_storage.archive(suffix)
+    logging.info(f"Migrated the JSON database into {sqlite_storage.path}. The JSON files were kept with the suffix {suffix}.")
+    return True
+
+# --- End of Storage Engines ---
 
 # Initialize database
 def init_db():
     if not os.path.exists(DB_DIR):
         os.makedirs(DB_DIR)
 
-    if not os.path.exists(DB_FILE):
-        db = {
-            "users": {}, "groups": {}, "unique_members": {}, "codes": {},
-            "settlements": {}, "support_tickets": {}, "admins": [ADMIN_ID],
-            "promotional_links": [f"https://t.me/{CHANNEL_USERNAME[1:]}"],
-            "next_code_id": 1, "next_ticket_id": 1
-        }
-        save_db(db)
+    storage = get_storage()
+    if not storage.exists() and storage.name == "sqlite" and JsonStorage().exists():
+        migrate_json_to_sqlite(storage)
+
+    if not storage.exists():
+        for segment in journal_segments(): # A journal without its snapshot cannot be replayed
+            orphaned_journal = f"{segment}_orphaned_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+            os.rename(segment, orphaned_journal)
+            logging.warning(f"Journal {segment} had no snapshot to replay onto. Kept as {orphaned_journal}.")
+        db = _empty_db()
         # Add initial admin user and codes if DB was just created
-        db = load_db() # Reload to work with the saved empty structure
         admin_user_id_str = str(ADMIN_ID)
         if admin_user_id_str not in db["users"]:
             db["users"][admin_user_id_str] = {
@@ -61,46 +766,654 @@ def init_db():
             }
             db["users"][admin_user_id_str].setdefault("codes", []).append(code_id)
             points_to_add_for_codes += 100
+        db["points_ledger"].append(ADMIN_ID, 0, 0, points_to_add_for_codes) # Opening balance for the sample codes
         db["users"][admin_user_id_str]["points"] = current_admin_points + points_to_add_for_codes
         save_db(db)
+        flush_db()
         logging.info(f"Initialized new database with admin user and 20 test codes ({points_to_add_for_codes} points).")
     return load_db()
 
 
 def load_db():
+    # Returns the resident database; the file is only parsed on first use.
+    db = _db_state["data"]
+    if db is None:
+        db = get_storage().load()
+        if db is None:
+            db = init_db() # Re-initialize
+        else:
+            _db_state["data"] = db
+            if get_storage().name == "json":
+                replayed = replay_journal(db)
+                if replayed:
+                    logging.info(f"Replayed {replayed} journal records on top of the {DB_FILE} snapshot.")
+                    # The next flush folds them into a new snapshot and removes the journal
+                    _db_state["journal_since"] = time.monotonic()
+                    mark_dirty()
+            reconcile_points(db)
+        recount_stats() # Counted once here, before any handler can change a counted row
+    return db
+
+def save_db(db_content, *collections):
+    # Marks the given collections (all of them by default; DB_META for top-level keys) or
+    # (collection, key) pairs dirty; see mark_dirty().
+    # The write-behind job persists them; without a job queue they are written through by the
+    # next group commit. In journal mode (collection, key) pairs are appended to the journal
+    # instead, so a single-row edit never rewrites its whole shard. Returns an awaitable for the
+    # commit, or None when durability is left to the write-behind job.
+    _db_state["data"] = db_content
+    rows = [target for target in collections if isinstance(target, tuple)]
+    if rows and journal_enabled():
+        durable = commit_db_changes(db_content, "save", [journal_row_change(db_content, *row) for row in rows])
+        collections = [target for target in collections if not isinstance(target, tuple)]
+        if not collections:
+            return durable
+    mark_dirty(*collections)
+    if not _db_state["write_behind"]:
+        return schedule_group_commit()
+    return None
+
+def mark_dirty(*targets):
+    # A collection name marks the whole collection; a (collection, key) pair marks one row (or one
+    # top-level key for DB_META), so SQLite writes just that row. No targets marks everything.
+    for target in targets or (*DB_COLLECTIONS, DB_META):
+        if isinstance(target, tuple):
+            _db_state["dirty_keys"].setdefault(target[0], set()).add(str(target[1]))
+        else:
+            _db_state["dirty"].add(target)
+
+def snapshot_rows(db, dirty_keys):
+    # collection -> {key: copy of the row, or None if it no longer exists}
+    rows = {}
+    for collection, keys in dirty_keys.items():
+        if collection == DB_META:
+            source = {key: db[key] for key in keys if key in db and key not in DB_COLLECTIONS}
+        else:
+            source = db.get(collection, {})
+        rows[collection] = {key: snapshot_db(source.get(key)) for key in keys}
+    return rows
+
+def flush_db(compact_journal=False):
+    # Starts a write of the dirty collections and rows, plus every row the journal touched when it
+    # is due for compaction. Returns an awaitable for the write, or None if there was nothing to write
+    # (or it ran inline).
+    if _db_state["data"] is None:
+        return None
+    in_flight = _db_state["flush_in_flight"]
+    # Outside its event loop (startup, or after the loop stopped) nothing would run the follow-up
+    if in_flight is not None and not in_flight.done() and in_flight.get_loop().is_running():
+        # One snapshot write at a time: the dirty set keeps accumulating and goes out in a single
+        # follow-up write once the current one finishes, instead of queueing a copy per call
+        _db_state["flush_compact"] |= compact_journal
+        if _db_state["flush_follow_up"] is None:
+            _db_state["flush_follow_up"] = in_flight.get_loop().create_future()
+            in_flight.add_done_callback(lambda _: start_follow_up_flush())
+        return _db_state["flush_follow_up"]
+    dirty = _db_state["dirty"]
+    dirty_keys = {c: set(keys) for c, keys in _db_state["dirty_keys"].items() if c not in dirty}
+    # A journal record replayed over a newer shard would roll it back, so writing a whole collection
+    # the journal touched means folding the whole journal into this snapshot. In journal mode
+    # row-level saves are journaled (see save_db), so only whole-collection writes, which are rare
+    # (initialization, replay, failed-write retries), get here outside of compaction.
+    journal_keys = _db_state["journal_keys"]
+    fold_journal = _db_state["journal_since"] is not None and (
+        compact_journal or journal_needs_compaction() or bool(dirty & set(journal_keys)))
+    journal_state = (journal_keys, _db_state["journal_bytes"], _db_state["journal_since"])
+    if fold_journal:
+        # The shards plus the journaled rows are the current state, so folding writes just those rows
+        for collection, keys in journal_keys.items():
+            dirty_keys.setdefault(collection, set()).update(keys)
+        _db_state["journal_keys"] = {}
+        _db_state["journal_bytes"] = 0
+        _db_state["journal_since"] = None
+    dirty |= {c for c in dirty_keys if c in get_storage().WHOLE_COLLECTIONS}
+    dirty_keys = {c: keys for c, keys in dirty_keys.items() if c not in dirty}
+    if not dirty and not dirty_keys:
+        return None
+    _db_state["dirty"] = set()
+    _db_state["dirty_keys"] = {}
+    snapshot = snapshot_db(split_db(_db_state["data"], dirty)) if dirty else {}
+    rows = snapshot_rows(_db_state["data"], dirty_keys)
+    failed = lambda: restore_failed_flush(dirty, dirty_keys, journal_state if fold_journal else None)
     try:
-        with open(DB_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        logging.warning(f"Database file {DB_FILE} not found. Initializing a new one.")
-        if not os.path.exists(DB_DIR): os.makedirs(DB_DIR)
-        empty_db = {
-            "users": {}, "groups": {}, "unique_members": {}, "codes": {},
-            "settlements": {}, "support_tickets": {}, "admins": [ADMIN_ID],
-            "promotional_links": [f"https://t.me/{CHANNEL_USERNAME[1:]}"],
-            "next_code_id": 1, "next_ticket_id": 1
+        write = run_db_io(write_snapshot, get_storage(), snapshot, rows, fold_journal)
+    except Exception: # Ran inline and failed
+        failed()
+        raise
+    if write is not None:
+        # Done callbacks run on the event loop, so the failure is handed back there before touching _db_state
+        write.add_done_callback(lambda done: done.cancelled() or done.exception() is None or failed())
+    _db_state["flush_in_flight"] = write
+    return write
+
+def restore_failed_flush(dirty, dirty_keys, journal_state):
+    # Event loop only. Re-marks what the failed write carried so the next flush retries it. If the
+    # write was folding the journal, its bookkeeping comes back too: the next flush then folds
+    # again, and that fold's seal_journal() also returns the segments sealed by this attempt, so
+    # they are removed once a snapshot finally covers them (until then startup replays them).
+    mark_dirty(*dirty, *((collection, key) for collection, keys in dirty_keys.items() for key in keys))
+    if journal_state is None:
+        return
+    journal_keys, journal_bytes, since = journal_state
+    for collection, keys in journal_keys.items():
+        _db_state["journal_keys"].setdefault(collection, set()).update(keys)
+    _db_state["journal_bytes"] += journal_bytes
+    if _db_state["journal_since"] is None or since < _db_state["journal_since"]:
+        _db_state["journal_since"] = since
+
+def start_follow_up_flush():
+    follow_up = _db_state["flush_follow_up"]
+    compact_journal = _db_state["flush_compact"]
+    _db_state["flush_follow_up"] = None
+    _db_state["flush_compact"] = False
+    _db_state["flush_in_flight"] = None
+    write = flush_db(compact_journal)
+    if write is None:
+        settle_future(follow_up, None)
+    else:
+        write.add_done_callback(lambda done: settle_future(follow_up, done))
+
+def settle_future(target, source):
+    # Resolves `target` with the outcome of the db-io future `source` (None counts as success).
+    # The failure has already been logged by _log_db_io_failure, so a target nobody awaits is
+    # marked retrieved rather than warned about again when it is garbage collected.
+    if target.done():
+        return
+    if source is not None and not source.cancelled() and source.exception() is not None:
+        target.set_exception(source.exception())
+        target.exception()
+    else:
+        target.set_result(None)
+
+def snapshot_db(value):
+    # Copy taken on the event loop, so the db-io thread never sees a half-applied mutation
+    if isinstance(value, dict):
+        return {k: snapshot_db(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [snapshot_db(v) for v in value]
+    if isinstance(value, set):
+        return set(value)
+    if isinstance(value, (UniqueMemberIndex, PointsLedger)):
+        return value.copy()
+    return value
+
+def write_snapshot(storage, snapshot, rows, fold_journal):
+    # Runs on the db-io thread. Sealing the journal here, in submission order, puts exactly the
+    # records appended before the snapshot was taken into the sealed segments.
+    # On failure flush_db() restores the dirty set and journal bookkeeping on the event loop.
+    sealed_segments = seal_journal() if fold_journal else []
+    if rows:
+        storage.save(snapshot, rows)
+    else:
+        storage.save(snapshot)
+    for segment in sealed_segments:
+        os.remove(segment)
+
+# --- Persistence Worker ---
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-io")
+
+def run_db_io(func, *args):
+    # Runs blocking persistence work on the single db-io thread, so writes happen in submission
+    # order. Returns an awaitable; outside the event loop (startup) the work runs inline instead.
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        func(*args)
+        return None
+    future = loop.run_in_executor(_db_executor, func, *args)
+    future.add_done_callback(_log_db_io_failure)
+    return future
+
+def _log_db_io_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"Database write failed on the db-io thread: {future.exception()}", exc_info=future.exception())
+
+async def drain_db_io():
+    # Waits until every write submitted so far has finished
+    await asyncio.get_running_loop().run_in_executor(_db_executor, lambda: None)
+
+# --- End of Persistence Worker ---
+
+# --- Transactions ---
+_entity_locks = {} # (kind, id) -> [asyncio.Lock, number of transactions using it]
+
+@contextlib.asynccontextmanager
+async def db_transaction(*entities):
+    """Serializes handlers on the records they touch and yields the resident database.
+
+    entities are (kind, id) pairs such as ("user", 123), ("group", -100456) or ("settlement", "1_2_3").
+    Handlers touching unrelated records still run in parallel. Locks are taken in sorted order,
+    so two transactions can never deadlock; a transaction must not be nested inside another.
+    """
+    keys = sorted({(kind, str(entity_id)) for kind, entity_id in entities})
+    registered, held = [], []
+    try:
+        for key in keys:
+            entry = _entity_locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+            registered.append(key)
+            await entry[0].acquire()
+            held.append(key)
+        yield load_db()
+    finally:
+        for key in reversed(registered):
+            entry = _entity_locks[key]
+            if key in held:
+                entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _entity_locks[key]
+
+# --- End of Transactions ---
+
+# --- Settlement Indexes ---
+# Derived from db["settlements"] and never persisted. Every status change must go through
+# put_settlement()/update_settlement() so the indexes stay in step with the rows.
+def settlement_index():
+    db = load_db()
+    index = _db_state["settlement_index"]
+    if index is None or index["db"] is not db: # First use, or the resident database was reloaded
+        index = _db_state["settlement_index"] = {
+            "db": db,
+            "active_by_code": {}, # code_id -> id of its pending settlement
+            "by_user": {}, # user_id -> {settlement_id: None}, in request order
+            "by_status": {}, # status -> {settlement_id: None}, in request order
+            "entries": {} # settlement_id -> (user_id, code_id, status) as currently indexed
+        }
+        for settlement_id, settlement in db.get("settlements", {}).items():
+            _index_settlement(index, settlement_id, settlement)
+    return index
+
+def _index_settlement(index, settlement_id, settlement):
+    previous = index["entries"].pop(settlement_id, None)
+    if previous is not None:
+        user_id, code_id, status = previous
+        index["by_user"].get(user_id, {}).pop(settlement_id, None)
+        index["by_status"].get(status, {}).pop(settlement_id, None)
+        if index["active_by_code"].get(code_id) == settlement_id:
+            del index["active_by_code"][code_id]
+    if settlement is None:
+        return
+    entry = (str(settlement.get("user_id")), str(settlement.get("code_id")), settlement.get("status"))
+    index["entries"][settlement_id] = entry
+    index["by_user"].setdefault(entry[0], {})[settlement_id] = None
+    index["by_status"].setdefault(entry[2], {})[settlement_id] = None
+    if entry[2] == "pending":
+        index["active_by_code"][entry[1]] = settlement_id
+
+def put_settlement(db, settlement_id, settlement):
+    index = settlement_index()
+    db.setdefault("settlements", {})[settlement_id] = settlement
+    _index_settlement(index, settlement_id, settlement)
+    return settlement
+
+def update_settlement(db, settlement_id, **fields):
+    settlement = db["settlements"][settlement_id]
+    settlement.update(fields)
+    _index_settlement(settlement_index(), settlement_id, settlement)
+    return settlement
+
+def active_settlement_for_code(code_id):
+    return settlement_index()["active_by_code"].get(str(code_id))
+
+def settlements_with_status(status):
+    # [(settlement_id, settlement)] in request order
+    settlements = load_db().get("settlements", {})
+    return [(settlement_id, settlements[settlement_id]) for settlement_id in settlement_index()["by_status"].get(status, {})]
+
+def count_settlements_with_status(status):
+    return len(settlement_index()["by_status"].get(status, {}))
+
+def user_settlement_ids(user_id):
+    return list(settlement_index()["by_user"].get(str(user_id), {}))
+
+# --- End of Settlement Indexes ---
+
+# --- Statistics Counters ---
+# Counters for the admin dashboard that would otherwise need a full scan. Sizes of whole
+# collections (users, groups, codes, ...) are read with len() and pending settlements come
+# from the settlement indexes. The counters are built when the database is loaded; handlers call
+# bump_stat() when the counted state changes.
+def stats_counters():
+    db = load_db()
+    counters = _db_state["stats"]
+    if counters is None or counters["db"] is not db:
+        counters = recount_stats()
+    return counters
+
+def recount_stats():
+    db = load_db()
+    counters = _db_state["stats"] = {
+        "db": db,
+        "registered_users": sum(1 for user_data in db.get("users", {}).values() if user_data.get("registered")),
+        "open_tickets": sum(1 for ticket in db.get("support_tickets", {}).values() if ticket.get("status") == "open")
+    }
+    return counters
+
+def bump_stat(name, delta=1):
+    # Callers change the row first, so counters built after that change already include it
+    counters = _db_state["stats"]
+    if counters is not None and counters["db"] is load_db():
+        counters[name] += delta
+
+# --- End of Statistics Counters ---
+
+# --- Leaderboard ---
+class ScoreRank:
+    """Ranks users by score with a Fenwick tree over score values (how many users hold each score).
+
+    update() and rank() are O(log S) for the highest score S, and top(n) costs O(n log S), so a
+    single user's rank never needs a scan over everyone. Users with a score of 0 are not ranked.
+    """
+
+    def __init__(self, size=1024):
+        self._size = size
+        self._tree = [0] * (size + 1)
+        self._scores = {} # user_id -> score
+        self._buckets = {} # score -> set of user_ids
+        self._count = 0 # users with a positive score
+
+    def _add(self, score, delta):
+        while score <= self._size:
+            self._tree[score] += delta
+            score += score & -score
+
+    def _prefix(self, score):
+        # Users with a score in 1..score
+        total = 0
+        while score > 0:
+            total += self._tree[score]
+            score -= score & -score
+        return total
+
+    def _find(self, target):
+        # Smallest score whose prefix count reaches target (binary lifting)
+        position, step = 0, 1 << (self._size.bit_length() - 1)
+        while step:
+            if position + step <= self._size and self._tree[position + step] < target:
+                position += step
+                target -= self._tree[position]
+            step >>= 1
+        return position + 1
+
+    def _grow(self, score):
+        self._size = max(score, self._size * 2)
+        tree = [0] * (self._size + 1)
+        for bucket_score, users in self._buckets.items():
+            tree[bucket_score] = len(users)
+        for i in range(1, self._size + 1): # O(S) bottom-up build
+            parent = i + (i & -i)
+            if parent <= self._size:
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def update(self, user_id, delta):
+        old = self._scores.get(user_id, 0)
+        new = old + delta
+        if old > 0:
+            self._add(old, -1)
+            self._buckets[old].discard(user_id)
+            if not self._buckets[old]:
+                del self._buckets[old]
+            self._count -= 1
+        if new > 0:
+            if new > self._size:
+                self._grow(new)
+            self._add(new, 1)
+            self._buckets.setdefault(new, set()).add(user_id)
+            self._count += 1
+            self._scores[user_id] = new
+        else:
+            self._scores.pop(user_id, None)
+
+    def score(self, user_id):
+        return self._scores.get(user_id, 0)
+
+    def rank(self, user_id):
+        # 1 + users with a strictly higher score; None when the user has no points here
+        score = self._scores.get(user_id, 0)
+        if score <= 0:
+            return None
+        return self._count - self._prefix(score) + 1
+
+    def __len__(self):
+        return self._count
+
+    def top(self, n):
+        rows, seen = [], 0
+        while len(rows) < n and seen < self._count:
+            score = self._find(self._count - seen) # The (seen + 1)-th highest score
+            users = sorted(self._buckets[score])
+            rows.extend((user_id, score) for user_id in users)
+            seen += len(users)
+        return rows[:n]
+
+
+def leaderboard(now=None):
+    """Returns {"all": ScoreRank, "day": ..., "week": ..., "month": ...}, synced with the points ledger.
+
+    Derived from db["points_ledger"] and never persisted. New ledger entries are applied
+    incrementally; each rolling window keeps a cursor into the ledger and takes entries back out
+    as they age past the window. Opening-balance entries only count towards "all". Released held
+    awards are appended with the time the member joined, so they can arrive already outside a
+    window; those are never added to it (and, inside it, leave it once the cursor reaches them).
+    """
+    db = load_db()
+    ledger = db["points_ledger"]
+    board = _db_state["leaderboard"]
+    if board is None or board["db"] is not db or board["ledger"] is not ledger:
+        board = _db_state["leaderboard"] = {
+            "db": db, "ledger": ledger, "applied": 0,
+            "ranks": {"all": ScoreRank(), **{window: ScoreRank() for window in LEADERBOARD_WINDOWS}},
+            "cursors": {window: 0 for window in LEADERBOARD_WINDOWS},
+            "skipped": {window: set() for window in LEADERBOARD_WINDOWS} # seqs appended after they expired
         }
-        save_db(empty_db) # Save the minimal structure first
-        return init_db() # Then call init_db to populate admin if it's truly new
-    except json.JSONDecodeError:
-        logging.error(f"Error decoding JSON from {DB_FILE}. File might be corrupted. Creating a backup and starting fresh.")
-        backup_file = f"{DB_FILE}_corrupted_{datetime.now().strftime('%Y%m%d%H%M%S')}.json"
-        if os.path.exists(DB_FILE): os.rename(DB_FILE, backup_file)
-        logging.info(f"Corrupted DB backed up to {backup_file}")
-        if not os.path.exists(DB_DIR): os.makedirs(DB_DIR)
-        return init_db() # Re-initialize
-
-def save_db(db_content):
+    ranks = board["ranks"]
+    now = now if now is not None else time.time()
+    for seq in range(board["applied"], len(ledger)):
+        adder_id, member_id, _, timestamp, delta = ledger.entry(seq)
+        ranks["all"].update(adder_id, delta)
+        if member_id:
+            for window, length in LEADERBOARD_WINDOWS.items():
+                if timestamp < now - length:
+                    board["skipped"][window].add(seq)
+                else:
+                    ranks[window].update(adder_id, delta)
+    board["applied"] = len(ledger)
+    for window, length in LEADERBOARD_WINDOWS.items():
+        cursor = board["cursors"][window]
+        skipped = board["skipped"][window]
+        while cursor < board["applied"]:
+            adder_id, member_id, _, timestamp, delta = ledger.entry(cursor)
+            if cursor in skipped:
+                skipped.discard(cursor) # Never added, so nothing to take back out
+            elif member_id: # Opening balances were never counted, so they never hold the cursor back
+                if timestamp >= now - length:
+                    break # Later entries are newer, apart from released held awards, which leave late
+                ranks[window].update(adder_id, -delta)
+            cursor += 1
+        board["cursors"][window] = cursor
+    return ranks
+
+# --- End of Leaderboard ---
+
+# --- Mutation Journal ---
+def journal_enabled():
+    return DB_JOURNAL_ENABLED and get_storage().name == "json"
+
+def commit_db_changes(db, op, changes):
+    """Persists a mutation that has already been applied to the resident database.
+
+    `changes` are idempotent post-images, so replaying a record that already made it into
+    the snapshot is harmless:
+        ["put", collection, key, row], ["del", collection, key], ["set", key, value],
+        ["member_add", group_id, member_id], ["member_remove", group_id, member_id]
+    In journal mode they are appended to DB_JOURNAL_FILE and fsynced by the next group commit;
+    otherwise the touched collections are marked dirty. Returns what save_db() returns.
+    """
+    if not journal_enabled():
+        return save_db(db, *{journal_change_key(change) for change in changes})
+    record = json.dumps({"op": op, "date": datetime.now().isoformat(), "changes": changes}, ensure_ascii=False, default=json_default) + "\n"
+    # If the append fails the next snapshot covers the change instead
+    failed = lambda: mark_dirty(*{journal_change_key(change) for change in changes})
     try:
-        with open(DB_FILE, 'w', encoding='utf-8') as f:
-            json.dump(db_content, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logging.error(f"Failed to save database to {DB_FILE}: {e}", exc_info=True)
+        append = run_db_io(append_journal_record, record)
+    except Exception: # Ran inline and failed
+        failed()
+        raise
+    if append is not None:
+        append.add_done_callback(lambda done: done.cancelled() or done.exception() is None or failed())
+    _db_state["journal_bytes"] += len(record)
+    for collection, key in {journal_change_key(change) for change in changes}:
+        _db_state["journal_keys"].setdefault(collection, set()).add(key)
+    if _db_state["journal_since"] is None:
+        _db_state["journal_since"] = time.monotonic()
+    return schedule_group_commit() # Also compacts once the journal is due when there is no write-behind job
+
+def append_journal_record(record):
+    # db-io thread only, like every other use of the journal file handle
+    if _db_state["journal"] is None:
+        _db_state["journal"] = open(DB_JOURNAL_FILE, 'a', encoding='utf-8')
+    _db_state["journal"].write(record)
+    _db_state["journal"].flush()
+
+def sync_journal():
+    if _db_state["journal"] is not None:
+        os.fsync(_db_state["journal"].fileno())
+
+def journal_row_change(db, collection, key):
+    # The current post-image of one row (or DB_META key) as a journal change
+    key = str(key)
+    if collection == DB_META:
+        return ["set", key, db.get(key)]
+    row = db.get(collection, {}).get(key)
+    return ["del", collection, key] if row is None else ["put", collection, key, row]
+
+def journal_change_key(change):
+    # The (collection, key) a change rewrites, for row-level dirty tracking
+    if change[0] in ("put", "del"):
+        return (change[1], str(change[2]))
+    if change[0] == "set":
+        return (DB_META, change[1])
+    return ("groups", str(change[1]))
+
+def apply_journal_changes(db, changes):
+    for change in changes:
+        kind = change[0]
+        if kind == "put":
+            row = change[3]
+            if change[1] == "groups":
+                row["members"] = to_member_set(row.get("members"))
+            db.setdefault(change[1], {})[str(change[2])] = row
+        elif kind == "del":
+            db.get(change[1], {}).pop(str(change[2]), None)
+        elif kind == "set":
+            db[change[1]] = change[2]
+        elif kind in ("member_add", "member_remove"):
+            group_data = db.get("groups", {}).get(str(change[1]))
+            if group_data is None:
+                continue
+            members = group_data.setdefault("members", set())
+            if kind == "member_add":
+                members.add(int(change[2]))
+            else:
+                members.discard(int(change[2]))
+        else:
+            logging.warning(f"apply_journal_changes: Unknown change type {kind!r}. Skipping.")
+
+def journal_segments():
+    # Sealed segments (oldest first) followed by the live journal file
+    prefix = os.path.basename(DB_JOURNAL_FILE) + "."
+    directory = os.path.dirname(DB_JOURNAL_FILE) or "."
+    sealed = sorted(
+        (int(name[len(prefix):]), os.path.join(directory, name))
+        for name in os.listdir(directory) if name.startswith(prefix) and name[len(prefix):].isdigit()
+    )
+    segments = [path for _, path in sealed]
+    if os.path.exists(DB_JOURNAL_FILE):
+        segments.append(DB_JOURNAL_FILE)
+    return segments
+
+def replay_journal(db):
+    replayed = 0
+    for segment in journal_segments():
+        with open(segment, 'r', encoding='utf-8') as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Only the last record of a segment can be torn by a crash mid-append
+                    logging.warning(f"replay_journal: Ignoring incomplete record at line {line_no} of {segment}.")
+                    break
+                apply_journal_changes(db, record.get("changes", []))
+                replayed += 1
+    return replayed
+
+def journal_needs_compaction():
+    since = _db_state["journal_since"]
+    if since is None:
+        return False
+    return _db_state["journal_bytes"] >= DB_JOURNAL_COMPACT_BYTES or time.monotonic() - since >= DB_JOURNAL_COMPACT_INTERVAL
+
+def seal_journal():
+    # Closes the live journal and renames it to a numbered segment; returns all sealed segments
+    if _db_state["journal"] is not None:
+        _db_state["journal"].close()
+        _db_state["journal"] = None
+    if os.path.exists(DB_JOURNAL_FILE):
+        os.rename(DB_JOURNAL_FILE, f"{DB_JOURNAL_FILE}.{time.time_ns()}")
+    return journal_segments()
+
+# --- End of Mutation Journal ---
+
+def schedule_group_commit():
+    # Coalesces every write requested within DB_GROUP_COMMIT_WINDOW into one flush/fsync
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError: # Startup code outside the event loop writes synchronously
+        run_group_commit()
+        return None
+    waiter = _db_state["group_commit"]
+    if waiter is None:
+        waiter = _db_state["group_commit"] = loop.create_future()
+        loop.call_later(DB_GROUP_COMMIT_WINDOW, run_group_commit)
+    return waiter
+
+def run_group_commit():
+    waiter = _db_state["group_commit"]
+    _db_state["group_commit"] = None
+    writes = [run_db_io(sync_journal)]
+    if not _db_state["write_behind"]:
+        writes.append(flush_db())
+    writes = [write for write in writes if write is not None]
+    if waiter is None:
+        return
+    if not writes:
+        waiter.set_result(None)
+    else:
+        # The waiter fails if either the fsync or the snapshot write did, so callers that await
+        # durability never confirm a change that is not on disk
+        done = asyncio.gather(*writes)
+        done.add_done_callback(lambda _: settle_future(waiter, done))
+
+async def db_write_behind_job(context: ContextTypes.DEFAULT_TYPE):
+    flush_db()
+
+async def flush_db_on_shutdown(application: Application):
+    write = flush_db(compact_journal=True)
+    if write is not None:
+        # May be a follow-up of a write still in flight, which drain_db_io() alone would not cover
+        await asyncio.wait([write])
+    await drain_db_io()
+    _db_executor.shutdown(wait=True)
+    logging.info("Pending database writes flushed to disk on shutdown.")
 
 # Keyboard layouts
 def get_main_keyboard():
     keyboard = [
-        ["امتیازات من 🏆", "کد های من 🎫"],
+        ["امتیازات من 🏆", "کد های من 🎫", "برترین‌ها 🥇"],
         ["تسویه حساب 💰", "ارتباط با پشتیبانی 📞"],
         ["ویرایش اطلاعات ✏️", "راهنما ❓"]
     ]
@@ -108,13 +1421,26 @@ def get_main_keyboard():
 
 def get_admin_keyboard():
     keyboard = [
-        ["آمار کلی 📊", "خروجی اکسل اعضا 📄"],
+        ["آمار کلی 📊", "خروجی اکسل اعضا 📄", "برترین‌ها 🥇"],
         ["مدیریت درخواست های تسویه 💳", "مدیریت درخواست های پشتیبانی 📮"],
         ["مدیریت لینک های تبلیغاتی 🔗", "ارسال پیام همگانی 📢"],
         ["مدیریت ادمین ها 👨‍💼", "برگشت به منو کاربران 🔙"]
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+def get_admin_stats_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 شمارش مجدد از ابتدا", callback_data="admin_stats_recount")],
+        [InlineKeyboardButton("🧮 بازسازی امتیازات از دفتر امتیاز", callback_data="admin_points_repair")]
+    ])
+
+def get_leaderboard_keyboard(window):
+    labels = {"all": "همه زمان‌ها", "day": "روز", "week": "هفته", "month": "ماه"}
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(("• " if key == window else "") + label, callback_data=f"leaderboard_{key}")
+        for key, label in labels.items()
+    ]])
+
 def get_edit_keyboard():
     keyboard = [
         ["ویرایش شماره تماس 📱", "ویرایش نام و نام خانوادگی 👤"],
@@ -123,6 +1449,312 @@ def get_edit_keyboard():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+# --- Rate Limiting ---
+class TokenBucket:
+    """Async token bucket: allows `rate` acquisitions per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        # Flood control: nobody sharing the bucket sends anything for `seconds`
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+OUTBOUND_PRIORITIES = {"interactive": 0, "notification": 1, "bulk": 2}
+
+class OutboundScheduler(BaseRateLimiter):
+    """Paces every Bot API request made through the application's bot.
+
+    Callers pick a priority class with rate_limit_args="notification" or "bulk"; anything else is
+    "interactive" (direct replies). A request first waits for its chat's bucket (message endpoints
+    only), then queues for the global bucket, which always serves the highest priority first.
+    RetryAfter is handled here: the chat (or, for chat-less requests, everything) pauses for the
+    requested time and the request is retried.
+    """
+    MESSAGE_ENDPOINT_PREFIXES = ("send", "edit", "copy", "forward")
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self):
+        self._global = TokenBucket(OUTBOUND_GLOBAL_RATE)
+        self._chats = {} # chat_id -> TokenBucket
+        self._queue = [] # heap of (priority, sequence, future) waiting for a global token
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+        self._waits = {name: [0, 0.0, 0.0] for name in OUTBOUND_PRIORITIES} # requests, total wait, max wait
+        self._retry_after_count = 0
+
+    async def initialize(self):
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._dispatcher
+            self._dispatcher = None
+
+    async def _dispatch(self):
+        while True:
+            while not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            await self._global.acquire()
+            while self._queue:
+                _, _, waiter = heapq.heappop(self._queue)
+                if not waiter.done(): # Skips requests whose caller was cancelled
+                    waiter.set_result(None)
+                    break
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                self._chats.clear() # Idle buckets are full anyway; forgetting them loses nothing
+            is_private = isinstance(chat_id, int) and chat_id > 0
+            bucket = self._chats[chat_id] = TokenBucket(
+                OUTBOUND_PRIVATE_CHAT_RATE if is_private else OUTBOUND_GROUP_CHAT_RATE, capacity=OUTBOUND_CHAT_BURST)
+        return bucket
+
+    async def _wait_for_slot(self, priority, chat_id):
+        started = time.monotonic()
+        if chat_id is not None:
+            await self._chat_bucket(chat_id).acquire()
+        if self._dispatcher is None: # Not initialized yet: plain global pacing
+            await self._global.acquire()
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._queue, (OUTBOUND_PRIORITIES[priority], next(self._sequence), waiter))
+            self._wakeup.set()
+            await waiter
+        waited = time.monotonic() - started
+        stats = self._waits[priority]
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if rate_limit_args in OUTBOUND_PRIORITIES else "interactive"
+        chat_id = data.get("chat_id") if endpoint.startswith(self.MESSAGE_ENDPOINT_PREFIXES) else None
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            await self._wait_for_slot(priority, chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self._retry_after_count += 1
+                if attempt == OUTBOUND_MAX_RETRIES:
+                    raise
+                delay = retry_after_seconds(e)
+                logging.warning(f"OutboundScheduler: Flood control on {endpoint} (chat {chat_id}). Retrying in {delay:.0f}s.")
+                (self._chat_bucket(chat_id) if chat_id is not None else self._global).pause(delay)
+
+    def metrics(self):
+        queue_depth = {name: 0 for name in OUTBOUND_PRIORITIES}
+        names = {level: name for name, level in OUTBOUND_PRIORITIES.items()}
+        for level, _, waiter in self._queue:
+            if not waiter.done():
+                queue_depth[names[level]] += 1
+        return {
+            "queue_depth": queue_depth,
+            "avg_wait": {name: (total / count if count else 0.0) for name, (count, total, _) in self._waits.items()},
+            "max_wait": {name: max_wait for name, (_, _, max_wait) in self._waits.items()},
+            "requests": {name: count for name, (count, _, _) in self._waits.items()},
+            "retry_after": self._retry_after_count
+        }
+
+def retry_after_seconds(error):
+    # RetryAfter.retry_after is an int or a timedelta depending on the PTB settings
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+# --- End of Rate Limiting ---
+
+# --- Update Processing ---
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently, but updates sharing a user or a chat run in arrival order.
+
+    Each update waits for the previous update of its user and of its chat, so conversations, the
+    settlement and ticket flows and per-group join tracking still see their updates one by one.
+    Only running updates take one of the `max_concurrent_updates` worker slots; the base class
+    semaphore just bounds how many updates are admitted at all.
+    """
+
+    def __init__(self, max_concurrent_updates=UPDATE_CONCURRENCY, max_pending_updates=UPDATE_MAX_PENDING):
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self._workers = asyncio.Semaphore(max_concurrent_updates)
+        self._tails = {} # key -> future of the last admitted update with that key
+
+    @staticmethod
+    def update_keys(update):
+        keys = set()
+        if isinstance(update, Update):
+            if update.effective_user: keys.add(("user", update.effective_user.id))
+            if update.effective_chat: keys.add(("chat", update.effective_chat.id))
+        return keys
+
+    async def do_process_update(self, update, coroutine):
+        keys = self.update_keys(update)
+        # Claim the tails before the first await so arrival order is kept
+        previous = {self._tails[key] for key in keys if key in self._tails}
+        done = asyncio.get_running_loop().create_future()
+        for key in keys:
+            self._tails[key] = done
+        started = False
+        try:
+            if previous:
+                await asyncio.wait(previous) # wait() never cancels the predecessors
+            async with self._workers:
+                started = True
+                await coroutine
+        finally:
+            pending = set()
+            if not started: # Cancelled while waiting: successors must still wait for our predecessors
+                coroutine.close()
+                pending = {future for future in previous if not future.done()}
+            if pending:
+                asyncio.ensure_future(asyncio.wait(pending)).add_done_callback(lambda _: self._release(keys, done))
+            else:
+                self._release(keys, done)
+
+    def _release(self, keys, done):
+        done.set_result(None)
+        for key in keys:
+            if self._tails.get(key) is done:
+                del self._tails[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# --- End of Update Processing ---
+
+# --- Bot Status Cache ---
+# The bot's own member status per group. my_chat_member updates overwrite entries as soon as the
+# bot is promoted, demoted or removed; the TTL only bounds how long a missed update can linger.
+_bot_status_cache = {} # chat_id -> (status, expires_at)
+
+def set_cached_bot_status(chat_id, status):
+    _bot_status_cache[int(chat_id)] = (status, time.monotonic() + BOT_STATUS_CACHE_TTL)
+
+async def get_bot_status(bot, chat_id):
+    cached = _bot_status_cache.get(int(chat_id))
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    bot_member = await bot.get_chat_member(chat_id, bot.id)
+    set_cached_bot_status(chat_id, bot_member.status)
+    return bot_member.status
+
+# --- End of Bot Status Cache ---
+
+# --- Admin Notifications ---
+# One summary per event kind when ADMIN_DIGEST_WINDOW is set; {count} is the number of coalesced events
+ADMIN_DIGEST_TEMPLATES = {
+    "support_ticket": "🔔 {count} درخواست پشتیبانی جدید دیگر دریافت شد. برای پاسخگویی، به پنل ادمین، بخش مدیریت درخواست‌های پشتیبانی مراجعه کنید.",
+    "settlement_request": "🔔 {count} درخواست تسویه حساب جدید دیگر دریافت شد. برای بررسی و پردازش، به پنل ادمین، بخش مدیریت درخواست‌های تسویه مراجعه کنید.",
+    "group_status": "🏢 {count} تغییر وضعیت دیگر در گروه‌ها:",
+}
+_admin_digests = {} # kind -> {"count": events held back, "lines": short descriptions}
+_admin_notification_tasks = set() # Keeps fire-and-forget sends alive until they finish
+
+def notify_admins(bot, kind, text, parse_mode=None, digest_line=None, reply_markup=None):
+    # Sends `text` to every admin concurrently without making the caller wait. In digest mode,
+    # later events of the same kind inside the window are only counted (digest_line is listed
+    # in the summary, if given).
+    if ADMIN_DIGEST_WINDOW > 0 and kind in ADMIN_DIGEST_TEMPLATES:
+        digest = _admin_digests.get(kind)
+        if digest is not None:
+            digest["count"] += 1
+            if digest_line:
+                digest["lines"].append(digest_line)
+            return None
+        _admin_digests[kind] = {"count": 0, "lines": []}
+        asyncio.get_running_loop().call_later(ADMIN_DIGEST_WINDOW, _flush_admin_digest, bot, kind)
+    return _spawn_admin_notification(send_to_admins(bot, text, parse_mode, reply_markup))
+
+def _flush_admin_digest(bot, kind):
+    digest = _admin_digests.pop(kind, None)
+    if not digest or not digest["count"]:
+        return
+    summary = ADMIN_DIGEST_TEMPLATES[kind].format(count=digest["count"])
+    if digest["lines"]:
+        summary += "\n" + "\n".join(digest["lines"][:20])
+        if len(digest["lines"]) > 20:
+            summary += f"\n... و {len(digest['lines']) - 20} مورد دیگر"
+    _spawn_admin_notification(send_to_admins(bot, summary))
+
+def _spawn_admin_notification(coroutine):
+    task = asyncio.create_task(coroutine)
+    _admin_notification_tasks.add(task)
+    task.add_done_callback(_admin_notification_tasks.discard)
+    return task
+
+async def send_to_admins(bot, text, parse_mode=None, reply_markup=None):
+    admin_ids = list(load_db().get("admins", []))
+    results = await asyncio.gather(
+        *(bot.send_message(admin_id_val, text, parse_mode=parse_mode, reply_markup=reply_markup, rate_limit_args="notification") for admin_id_val in admin_ids),
+        return_exceptions=True
+    )
+    for admin_id_val, result in zip(admin_ids, results):
+        if isinstance(result, Exception):
+            logging.warning(f"send_to_admins: Failed to notify admin {admin_id_val}: {result}")
+
+# --- End of Admin Notifications ---
+
+# --- Admin Profile Cache ---
+_admin_profiles = {} # user_id -> (name, username, expires_at)
+
+def remember_admin_profile(user_id, name, username):
+    _admin_profiles[user_id] = (name, username, time.monotonic() + ADMIN_PROFILE_CACHE_TTL)
+
+async def _fetch_admin_profile(bot, admin_id_val):
+    try:
+        chat = await bot.get_chat(int(admin_id_val))
+    except Exception as e:
+        logging.warning(f"Could not fetch info for admin ID {admin_id_val}: {e}")
+        return
+    remember_admin_profile(admin_id_val, chat.full_name or chat.first_name, chat.username)
+
+async def get_admin_profiles(bot, admin_ids):
+    # admin_id -> (name, username), or None when Telegram could not tell us; misses are fetched concurrently
+    now = time.monotonic()
+    missing = [admin_id_val for admin_id_val in admin_ids if _admin_profiles.get(admin_id_val, (None, None, 0))[2] <= now]
+    if missing:
+        await asyncio.gather(*(_fetch_admin_profile(bot, admin_id_val) for admin_id_val in missing))
+    profiles = {}
+    for admin_id_val in admin_ids:
+        cached = _admin_profiles.get(admin_id_val)
+        profiles[admin_id_val] = cached[:2] if cached else None
+    return profiles
+
+async def refresh_admin_profile_from_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Runs before the other handlers (group -1) for every update; admins' own updates keep the cache warm
+    user = update.effective_user
+    if user and user.id in load_db().get("admins", []):
+        remember_admin_profile(user.id, user.full_name, user.username)
+
+# --- End of Admin Profile Cache ---
+
 # --- Group Management ---
 async def unified_bot_status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.my_chat_member:
@@ -137,69 +1769,70 @@ async def unified_bot_status_handler(update: Update, context: ContextTypes.DEFAU
     new_status = update.my_chat_member.new_chat_member.status
     old_chat_member_obj = update.my_chat_member.old_chat_member
     old_status = old_chat_member_obj.status if old_chat_member_obj else "absent"
-
-    db = load_db()
-    admins_to_notify = db.get("admins", [])
-
-    if "groups" not in db or not isinstance(db.get("groups"), dict):
-        db["groups"] = {}
-
-    group_existed_in_db = group_id_str in db["groups"]
-    # Preserve members if group already existed, otherwise initialize empty
-    existing_members = db.get("groups", {}).get(group_id_str, {}).get("members", [])
-
-    if new_status in ['administrator', 'creator']:
-        if not group_existed_in_db or db["groups"].get(group_id_str, {}).get("title") != group_title:
-            db["groups"][group_id_str] = {"title": group_title, "members": existing_members}
-            save_db(db)
-            logging.info(f"unified_bot_status_handler: Bot is now admin in '{group_title}' ({group_id_str}). Title updated/Group added to db.")
-        else:
-            if "members" not in db["groups"][group_id_str]:
-                 db["groups"][group_id_str]["members"] = existing_members
-                 save_db(db)
-            logging.info(f"unified_bot_status_handler: Bot confirmed as admin in '{group_title}' ({group_id_str}). No changes to title needed.")
-
-        message_to_admins = f"✅ ربات در گروه زیر ادمین شد (یا وضعیت ادمین بودن آن تایید شد):\nنام: {group_title}\nآیدی: {group_id_str}"
-        if old_status in ['member', 'absent', 'left', 'kicked', None] or not group_existed_in_db:
-             for admin_id_val in admins_to_notify:
-                try:
-                    await context.bot.send_message(admin_id_val, message_to_admins)
-                except Exception as e:
-                    logging.warning(f"unified_bot_status_handler: Failed to notify admin {admin_id_val} about admin promotion: {e}")
-
-    elif new_status == 'member':
-        if group_existed_in_db:
-            del db["groups"][group_id_str]
-            save_db(db)
-            logging.info(f"unified_bot_status_handler: Bot is now a non-admin member in '{group_title}' ({group_id_str}). Removed from admin-groups db.")
-            message_to_admins = f"⚠️ ربات در گروه زیر دیگر ادمین نیست (یا به عضو عادی تنزل یافته):\nنام: {group_title}"
-            for admin_id_val in admins_to_notify:
-                try:
-                    await context.bot.send_message(admin_id_val, message_to_admins)
-                except Exception as e:
-                    logging.warning(f"unified_bot_status_handler: Failed to notify admin {admin_id_val} about demotion: {e}")
-
-        if old_status in ['absent', 'left', 'kicked', None]:
-            logging.info(f"unified_bot_status_handler: Bot added as a member to group '{group_title}' ({group_id_str}).")
-            try:
-                await context.bot.send_message(
-                    int(group_id_str),
-                    "ربات با موفقیت به گروه اضافه شد. برای فعال شدن قابلیت امتیازدهی و سایر امکانات، لطفاً ربات را ادمین کنید."
-                )
-            except Exception as e:
-                logging.warning(f"unified_bot_status_handler: Could not send 'promote me' message to {group_title}: {e}")
-
-    elif new_status in ['left', 'kicked']:
-        if group_existed_in_db:
-            del db["groups"][group_id_str]
-            save_db(db)
-            logging.info(f"unified_bot_status_handler: Bot was removed/left from '{group_title}' ({group_id_str}). Removed from db.")
-            message_to_admins = f"❌ ربات از گروه زیر حذف شد یا اخراج گردید:\nنام: {group_title}"
-            for admin_id_val in admins_to_notify:
+    set_cached_bot_status(chat.id, new_status)
+
+    async with db_transaction(("group", group_id_str)) as db:
+        if "groups" not in db or not isinstance(db.get("groups"), dict):
+            db["groups"] = {}
+
+        group_existed_in_db = group_id_str in db["groups"]
+        # Preserve members if group already existed, otherwise initialize empty
+        existing_members = db.get("groups", {}).get(group_id_str, {}).get("members", set())
+
+        if new_status in ['administrator', 'creator']:
+            if not group_existed_in_db or db["groups"].get(group_id_str, {}).get("title") != group_title:
+                # Other fields such as refreshed_at are kept; the title just came from Telegram, so it is fresh
+                db["groups"][group_id_str] = {
+                    **db["groups"].get(group_id_str, {}),
+                    "title": group_title, "members": existing_members, "refreshed_at": datetime.now().isoformat()
+                }
+                save_db(db, ("groups", group_id_str))
+                logging.info(f"unified_bot_status_handler: Bot is now admin in '{group_title}' ({group_id_str}). Title updated/Group added to db.")
+            else:
+                if "members" not in db["groups"][group_id_str]:
+                     db["groups"][group_id_str]["members"] = existing_members
+                     save_db(db, ("groups", group_id_str))
+                logging.info(f"unified_bot_status_handler: Bot confirmed as admin in '{group_title}' ({group_id_str}). No changes to title needed.")
+
+            message_to_admins = f"✅ ربات در گروه زیر ادمین شد (یا وضعیت ادمین بودن آن تایید شد):\nنام: {group_title}\nآیدی: {group_id_str}"
+            if old_status in ['member', 'absent', 'left', 'kicked', None] or not group_existed_in_db:
+                notify_admins(context.bot, "group_status", message_to_admins, digest_line=f"✅ ادمین شد: {group_title}")
+
+        elif new_status == 'member':
+            if group_existed_in_db:
+                del db["groups"][group_id_str]
+                save_db(db, ("groups", group_id_str))
+                logging.info(f"unified_bot_status_handler: Bot is now a non-admin member in '{group_title}' ({group_id_str}). Removed from admin-groups db.")
+                message_to_admins = f"⚠️ ربات در گروه زیر دیگر ادمین نیست (یا به عضو عادی تنزل یافته):\nنام: {group_title}"
+                notify_admins(context.bot, "group_status", message_to_admins, digest_line=f"⚠️ دیگر ادمین نیست: {group_title}")
+
+            if old_status in ['absent', 'left', 'kicked', None]:
+                logging.info(f"unified_bot_status_handler: Bot added as a member to group '{group_title}' ({group_id_str}).")
                 try:
-                    await context.bot.send_message(admin_id_val, message_to_admins)
+                    await context.bot.send_message(
+                        int(group_id_str),
+                        "ربات با موفقیت به گروه اضافه شد. برای فعال شدن قابلیت امتیازدهی و سایر امکانات، لطفاً ربات را ادمین کنید.",
+                        rate_limit_args="notification"
+                    )
                 except Exception as e:
-                    logging.warning(f"unified_bot_status_handler: Failed to notify admin {admin_id_val} about removal: {e}")
+                    logging.warning(f"unified_bot_status_handler: Could not send 'promote me' message to {group_title}: {e}")
+
+        elif new_status in ['left', 'kicked']:
+            if group_existed_in_db:
+                del db["groups"][group_id_str]
+                save_db(db, ("groups", group_id_str))
+                logging.info(f"unified_bot_status_handler: Bot was removed/left from '{group_title}' ({group_id_str}). Removed from db.")
+                message_to_admins = f"❌ ربات از گروه زیر حذف شد یا اخراج گردید:\nنام: {group_title}"
+                notify_admins(context.bot, "group_status", message_to_admins, digest_line=f"❌ حذف شد: {group_title}")
+
+async def fetch_group_chat(bot, group_id_str, semaphore):
+    # One get_chat under the shared concurrency limit. Pacing and flood-control retries are left to
+    # the outbound scheduler, and the timeout covers only the HTTP request, not time spent queued there.
+    async with semaphore:
+        return await bot.get_chat(
+            int(group_id_str), rate_limit_args="bulk",
+            connect_timeout=GROUP_REFRESH_TIMEOUT, read_timeout=GROUP_REFRESH_TIMEOUT
+        )
 
 async def update_groups_list_simplified(context_or_bot):
     db_snapshot = load_db()
@@ -210,57 +1843,115 @@ async def update_groups_list_simplified(context_or_bot):
     if "groups" not in db_snapshot or not isinstance(db_snapshot.get("groups"), dict):
         logging.warning("update_groups_list_simplified: 'groups' key missing or not a dict, initializing.")
         db_snapshot["groups"] = {}
-        save_db(db_snapshot)
+        save_db(db_snapshot, "groups")
 
     current_groups_in_db = db_snapshot["groups"]
     if not current_groups_in_db:
         logging.info("update_groups_list_simplified: No groups found in DB to process.")
         return 0
 
-    titles_changed = False
-    groups_processed_count = 0
+    started_at = time.monotonic()
+    group_ids = list(current_groups_in_db.keys())
+    semaphore = asyncio.Semaphore(GROUP_REFRESH_CONCURRENCY)
+    results = await asyncio.gather(
+        *(fetch_group_chat(bot_instance, group_id_str, semaphore) for group_id_str in group_ids),
+        return_exceptions=True
+    )
 
-    for group_id_str in list(current_groups_in_db.keys()):
-        groups_processed_count += 1
+    # Applied without awaiting, so no other handler can interleave with these writes
+    refreshed_at = datetime.now().isoformat()
+    refreshed = []
+    titles_changed = []
+    failed_count = 0
+    for group_id_str, result in zip(group_ids, results):
         original_group_data = current_groups_in_db.get(group_id_str)
         if not original_group_data:
-            logging.error(f"update_groups_list_simplified: Group ID {group_id_str} was in keys but data is missing. Skipping.")
+            logging.info(f"update_groups_list_simplified: Group ID {group_id_str} was removed while refreshing. Skipping.")
             continue
 
         current_title_in_db = original_group_data.get("title", group_id_str)
-        new_title = current_title_in_db
-
-        try:
-            group_id_int = int(group_id_str)
-            chat_info = await bot_instance.get_chat(group_id_int) 
-            new_title = chat_info.title if chat_info.title else f"گروه بدون عنوان ({group_id_str})"
-
-            if current_title_in_db != new_title:
-                logging.info(f"update_groups_list_simplified: Title for group {group_id_str} changed from '{current_title_in_db}' to '{new_title}'. Updating.")
-                current_groups_in_db[group_id_str]["title"] = new_title
-                titles_changed = True
-            else:
-                logging.info(f"update_groups_list_simplified: Title for group '{new_title}' ({group_id_str}) is current.")
+        if isinstance(result, BaseException):
+            failed_count += 1
+            logging.error(f"update_groups_list_simplified: Error processing group '{current_title_in_db}' ({group_id_str}): {result!r}. Group will remain in DB as per new logic.", exc_info=False)
+            continue
 
-        except Exception as e:
-            logging.error(f"update_groups_list_simplified: Error processing group '{current_title_in_db}' ({group_id_str}): {e}. Group will remain in DB as per new logic.", exc_info=False)
+        new_title = result.title if result.title else f"گروه بدون عنوان ({group_id_str})"
+        original_group_data["refreshed_at"] = refreshed_at
+        refreshed.append(group_id_str)
+        if current_title_in_db != new_title:
+            logging.info(f"update_groups_list_simplified: Title for group {group_id_str} changed from '{current_title_in_db}' to '{new_title}'. Updating.")
+            original_group_data["title"] = new_title
+            titles_changed.append(group_id_str)
 
-    if titles_changed:
-        logging.info("update_groups_list_simplified: Saving DB due to title changes.")
-        save_db(db_snapshot)
-    else:
-        logging.info("update_groups_list_simplified: No title changes detected, DB not saved by this function.")
+    if refreshed:
+        # refreshed_at is saved too, so a restart does not make every group look stale again
+        logging.info(f"update_groups_list_simplified: Saving {len(refreshed)} refreshed groups ({len(titles_changed)} title changes).")
+        save_db(db_snapshot, *(("groups", group_id_str) for group_id_str in refreshed))
 
     final_group_count = len(current_groups_in_db)
-    logging.info(f"update_groups_list_simplified: Finished. {groups_processed_count} groups processed. {final_group_count} groups currently in DB.")
+    elapsed = time.monotonic() - started_at
+    logging.info(f"update_groups_list_simplified: Finished in {elapsed:.1f}s. {len(group_ids)} groups processed ({failed_count} failed). {final_group_count} groups currently in DB.")
     return final_group_count
 
 
+# Admin views render from the stored metadata and only kick off a refresh in the background
+_group_refresh = {"task": None}
+
+def refresh_groups(bot):
+    # Starts a refresh pass unless one is already running; returns the (shared) task
+    task = _group_refresh["task"]
+    if task is None or task.done():
+        task = _group_refresh["task"] = asyncio.create_task(update_groups_list_simplified(bot))
+        task.add_done_callback(_log_group_refresh_failure)
+    return task
+
+def _log_group_refresh_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Background group refresh failed: {task.exception()}", exc_info=task.exception())
+
+def groups_metadata_age(db):
+    # Seconds since the least recently refreshed group was refreshed; None (stale) when there are
+    # no groups or some group was never refreshed.
+    groups = db.get("groups", {})
+    timestamps = [group_data.get("refreshed_at") for group_data in groups.values()]
+    if not timestamps or None in timestamps:
+        return None
+    oldest = min(timestamps)
+    return max(0, (datetime.now() - datetime.fromisoformat(oldest)).total_seconds())
+
+def revalidate_groups_if_stale(bot, db):
+    # Returns a line describing how fresh the group data is, starting a refresh when it is too old
+    age = groups_metadata_age(db)
+    refreshing = _group_refresh["task"] is not None and not _group_refresh["task"].done()
+    if not refreshing and (age is None or age > GROUP_METADATA_MAX_AGE):
+        refresh_groups(bot)
+        refreshing = True
+    if age is None:
+        freshness = "🕒 اطلاعات گروه‌ها هنوز به‌روزرسانی نشده است"
+    elif age < 60:
+        freshness = "🕒 اطلاعات گروه‌ها کمتر از یک دقیقه پیش به‌روزرسانی شده است"
+    elif age < 3600:
+        freshness = f"🕒 اطلاعات گروه‌ها {int(age // 60)} دقیقه پیش به‌روزرسانی شده است"
+    else:
+        freshness = f"🕒 اطلاعات گروه‌ها {int(age // 3600)} ساعت پیش به‌روزرسانی شده است"
+    if refreshing:
+        freshness += " (در حال به‌روزرسانی در پس‌زمینه...)"
+    return freshness
+
+async def post_init(application: Application):
+    start_join_pipeline(application.bot)
+    await resume_broadcast_jobs(application)
+    await post_startup_group_check(application)
+
+async def post_stop(application: Application):
+    await stop_broadcast_jobs()
+    await stop_join_pipeline(application)
+
 async def post_startup_group_check(application: Application):
     try:
         await asyncio.sleep(10)
         logging.info("Running initial group data update after startup...")
-        active_groups_count = await update_groups_list_simplified(application.bot)
+        active_groups_count = await refresh_groups(application.bot)
         logging.info(f"Initial group data update complete: {active_groups_count} groups in DB processed.")
     except Exception as e:
         logging.error(f"Error during post_startup_group_check: {e}", exc_info=True)
@@ -268,21 +1959,474 @@ async def post_startup_group_check(application: Application):
 async def periodic_group_check(context: ContextTypes.DEFAULT_TYPE):
     try:
         logging.info("Running periodic group data update...")
-        group_count = await update_groups_list_simplified(context.bot)
+        group_count = await refresh_groups(context.bot)
         logging.info(f"Periodic group data update: {group_count} groups in DB processed.")
     except Exception as e:
         logging.error(f"Error in periodic group check: {e}", exc_info=True)
 
 # --- End of Group Management ---
 
-async def check_channel_membership(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+# --- Broadcast Jobs ---
+# A broadcast is a persisted job in db["broadcasts"] with one state per target group
+# ("pending", "sent" or "failed"). Progress is saved as it happens, so a job that was
+# interrupted by a restart ("running") or a clean shutdown ("paused") resumes with the groups
+# that were still pending. A job stopped by an unexpected error is left "failed".
+# Sends are "bulk" requests, so the OutboundScheduler paces them behind replies and notifications.
+_broadcast_tasks = {} # job_id -> running asyncio task
+
+def create_broadcast_job(db, admin_id, text, group_ids):
+    job_id = str(db.get("next_broadcast_id", 1))
+    db["next_broadcast_id"] = int(job_id) + 1
+    db.setdefault("broadcasts", {})[job_id] = {
+        "created_by": admin_id, "created_at": datetime.now().isoformat(), "text": text,
+        "status": "running", "finished_at": None, "status_chat_id": None, "status_message_id": None,
+        "targets": {group_id_str: {"state": "pending", "error": None} for group_id_str in group_ids}
+    }
+    save_db(db, ("broadcasts", job_id), (DB_META, "next_broadcast_id"))
+    return job_id
+
+def start_broadcast_job(bot, job_id):
+    if job_id in _broadcast_tasks:
+        return _broadcast_tasks[job_id]
+    task = _broadcast_tasks[job_id] = asyncio.create_task(run_broadcast_job(bot, job_id))
+    task.add_done_callback(lambda t: _finish_broadcast_task(job_id, t))
+    return task
+
+def _finish_broadcast_task(job_id, task):
+    _broadcast_tasks.pop(job_id, None)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Broadcast job {job_id} failed: {task.exception()}", exc_info=task.exception())
+
+async def resume_broadcast_jobs(application: Application):
+    for job_id, job in load_db().get("broadcasts", {}).items():
+        if job.get("status") in ("running", "paused"):
+            logging.info(f"Resuming broadcast job {job_id}.")
+            job["status"] = "running"
+            start_broadcast_job(application.bot, job_id)
+
+async def stop_broadcast_jobs():
+    # Cancelled jobs save themselves as "paused" with their per-group progress, before the final flush
+    tasks = list(_broadcast_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if tasks:
+        logging.info(f"Paused {len(tasks)} running broadcast jobs for shutdown.")
+
+async def run_broadcast_job(bot, job_id):
+    job = load_db()["broadcasts"][job_id]
+    pending = iter([group_id_str for group_id_str, target in job["targets"].items() if target["state"] == "pending"])
+    workers = [asyncio.create_task(_broadcast_worker(bot, job_id, job, pending)) for _ in range(BROADCAST_CONCURRENCY)]
+    try:
+        while True:
+            done, running = await asyncio.wait(workers, timeout=BROADCAST_PROGRESS_INTERVAL)
+            if not running:
+                break
+            await edit_broadcast_status(bot, job_id, job)
+        for worker in done:
+            worker.result() # Surface unexpected worker errors
+        job["status"] = "done"
+    except asyncio.CancelledError:
+        job["status"] = "paused" # Shutdown; resumed with the remaining groups on the next start
+        raise
+    except Exception:
+        job["status"] = "failed" # Not resumed, so a job that keeps crashing is not re-run forever
+        raise
+    finally:
+        for worker in workers:
+            worker.cancel()
+        if job["status"] != "paused":
+            job["finished_at"] = datetime.now().isoformat()
+        save_db(load_db(), ("broadcasts", job_id))
+        if job["status"] != "paused":
+            await edit_broadcast_status(bot, job_id, job)
+    sent_count, failed_count = broadcast_counts(job)
+    logging.info(f"Broadcast job {job_id} finished: {sent_count} sent, {failed_count} failed.")
+
+async def _broadcast_worker(bot, job_id, job, pending):
+    # Workers share one iterator of pending targets, so every group is sent to exactly once
+    for group_id_str in pending:
+        target = job["targets"][group_id_str]
+        try:
+            # The scheduler already retries flood control; a RetryAfter that reaches here fails the group
+            await bot.send_message(int(group_id_str), job["text"], rate_limit_args="bulk")
+            target["state"] = "sent"
+        except Exception as e:
+            target["state"], target["error"] = "failed", type(e).__name__
+            logging.error(f"Failed to send broadcast to group {group_id_str}: {e}")
+        save_db(load_db(), ("broadcasts", job_id))
+
+def broadcast_counts(job):
+    states = [target["state"] for target in job["targets"].values()]
+    return states.count("sent"), states.count("failed")
+
+def broadcast_status_text(job_id, job):
+    sent_count, failed_count = broadcast_counts(job)
+    total = len(job["targets"])
+    if job["status"] in ("running", "paused"):
+        return (f"📣 ارسال پیام همگانی (شماره {job_id})\n\n"
+                f"⏳ در حال ارسال... {sent_count + failed_count} از {total}\n"
+                f"✅ موفق: {sent_count}\n❌ ناموفق: {failed_count}")
+    result_message = f"📣 نتیجه ارسال پیام همگانی (شماره {job_id}):\n\n"
+    if job["status"] == "failed":
+        result_message += f"⚠️ ارسال به دلیل خطای غیرمنتظره متوقف شد و {total - sent_count - failed_count} گروه ارسال نشده باقی ماند.\n"
+    result_message += f"✅ با موفقیت به {sent_count} گروه ارسال شد.\n"
+    if failed_count > 0:
+        result_message += f"❌ ارسال به {failed_count} گروه ناموفق بود.\n"
+        groups = load_db().get("groups", {})
+        failed_group_details = [
+            f"- گروه '{groups.get(group_id_str, {}).get('title', group_id_str)}' (ID: {group_id_str}): {target['error']}"
+            for group_id_str, target in job["targets"].items() if target["state"] == "failed"
+        ]
+        result_message += "\nجزئیات گروه‌های ناموفق:\n" + "\n".join(failed_group_details[:30])
+        if len(failed_group_details) > 30:
+            result_message += f"\n... و {len(failed_group_details) - 30} گروه دیگر"
+        result_message += "\n\n(دلایل رایج عدم موفقیت: ربات دیگر در گروه عضو نیست، ادمین نیست، یا از گروه اخراج شده است. جزئیات بیشتر در لاگ‌های سرور ربات موجود است.)"
+    return result_message
+
+async def edit_broadcast_status(bot, job_id, job):
+    if job.get("status_message_id") is None:
+        return
     try:
-        member = await context.bot.get_chat_member(CHANNEL_ID, user_id)
-        return member.status not in ['left', 'kicked']
+        await bot.edit_message_text(broadcast_status_text(job_id, job), chat_id=job["status_chat_id"], message_id=job["status_message_id"], rate_limit_args="notification")
+    except Exception as e: # e.g. "message is not modified" when nothing was sent since the last edit
+        logging.debug(f"Broadcast job {job_id}: Status message not updated: {e}")
+
+# --- End of Broadcast Jobs ---
+
+# --- Channel Membership Cache ---
+_channel_membership_cache = {} # user_id -> (is_member, expires_at)
+_channel_membership_lookups = {} # user_id -> in-flight get_chat_member task, shared by concurrent checks
+
+def cache_channel_membership(user_id, is_member):
+    ttl = CHANNEL_MEMBER_CACHE_TTL if is_member else CHANNEL_NON_MEMBER_CACHE_TTL
+    _channel_membership_cache[user_id] = (is_member, time.monotonic() + ttl)
+
+async def _fetch_channel_membership(bot, user_id):
+    try:
+        member = await bot.get_chat_member(CHANNEL_ID, user_id)
     except Exception as e:
         logging.error(f"Error checking channel membership for user {user_id} in channel {CHANNEL_ID}: {e}")
-        return True
+        return True # Not cached, the next check asks again
+    is_member = member.status not in ['left', 'kicked']
+    cache_channel_membership(user_id, is_member)
+    return is_member
+
+async def check_channel_membership(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    cached = _channel_membership_cache.get(user_id)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    lookup = _channel_membership_lookups.get(user_id)
+    if lookup is None:
+        lookup = asyncio.ensure_future(_fetch_channel_membership(context.bot, user_id))
+        _channel_membership_lookups[user_id] = lookup
+        lookup.add_done_callback(lambda _: _channel_membership_lookups.pop(user_id, None))
+    return await asyncio.shield(lookup) # A cancelled caller must not cancel the lookup for the others
+
+async def track_channel_membership(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # chat_member updates are only delivered for chats where the bot is an admin
+    chat_member_update = update.chat_member
+    if not chat_member_update or chat_member_update.chat.id != CHANNEL_ID:
+        return
+    new_member = chat_member_update.new_chat_member
+    cache_channel_membership(new_member.user.id, new_member.status not in ['left', 'kicked'])
+
+# --- End of Channel Membership Cache ---
+
+# --- Fraud Detection ---
+FRAUD_REASON_LABELS = {
+    "join_rate": "تعداد بسیار زیاد عضو افزوده‌شده توسط این کاربر",
+    "group_join_rate": "ورود غیرعادی زیاد اعضا به این گروه",
+    "quick_leaves": "خروج سریع بخش زیادی از اعضای افزوده‌شده",
+    "botlike_usernames": "نام کاربری شبیه حساب‌های جعلی در بخش زیادی از اعضا",
+}
+
+class FraudDetector:
+    """Sliding-window join/leave statistics per adder and per group, for spotting point farming.
+
+    Every counted event sits in one time-ordered deque and adds to [joins, botlike, quick_leaves]
+    counters of its adder and its group; events older than FRAUD_WINDOW are popped and subtracted
+    again. Recording, expiring and judging an event are all O(1) amortized, and memory is bounded
+    by the events inside the window. Kept in memory only: a restart starts with empty windows.
+    """
+    JOINS, BOTLIKE, QUICK_LEAVES = range(3)
+
+    def __init__(self):
+        self._events = deque() # (timestamp, field, adder_id, group_id, member_id)
+        self._stats = {} # ("adder", id) / ("group", id) -> [joins, botlike, quick_leaves]
+        self._recent_joins = {} # member_id -> (timestamp, adder_id, group_id) of the last join inside the window
+
+    def _record(self, timestamp, field, adder_id, group_id, member_id=None):
+        self._events.append((timestamp, field, adder_id, group_id, member_id))
+        for key in (("adder", adder_id), ("group", group_id)):
+            self._stats.setdefault(key, [0, 0, 0])[field] += 1
+
+    def _expire(self, now):
+        cutoff = now - FRAUD_WINDOW
+        while self._events and self._events[0][0] < cutoff:
+            timestamp, field, adder_id, group_id, member_id = self._events.popleft()
+            for key in (("adder", adder_id), ("group", group_id)):
+                stats = self._stats[key]
+                stats[field] -= 1
+                if not any(stats):
+                    del self._stats[key]
+            if field == self.JOINS and self._recent_joins.get(member_id, (None,))[0] == timestamp:
+                del self._recent_joins[member_id]
+
+    def observe_join(self, adder_id, group_id, member_id, username, timestamp):
+        # Returns the reasons (keys of FRAUD_REASON_LABELS) this adder or group looks suspicious right now
+        self._expire(timestamp)
+        self._record(timestamp, self.JOINS, adder_id, group_id, member_id)
+        self._recent_joins[member_id] = (timestamp, adder_id, group_id)
+        if username and FRAUD_BOTLIKE_USERNAME.match(username):
+            self._record(timestamp, self.BOTLIKE, adder_id, group_id)
+        return self.reasons(adder_id, group_id)
+
+    def observe_leave(self, group_id, member_id, timestamp):
+        self._expire(timestamp)
+        joined = self._recent_joins.get(member_id)
+        if joined and joined[2] == group_id and timestamp - joined[0] <= FRAUD_QUICK_LEAVE_SECONDS:
+            del self._recent_joins[member_id]
+            self._record(timestamp, self.QUICK_LEAVES, joined[1], group_id)
+
+    def reasons(self, adder_id, group_id):
+        adder_stats = self._stats.get(("adder", adder_id), [0, 0, 0])
+        group_stats = self._stats.get(("group", group_id), [0, 0, 0])
+        reasons = []
+        if adder_stats[self.JOINS] > FRAUD_MAX_JOINS_PER_ADDER:
+            reasons.append("join_rate")
+        if group_stats[self.JOINS] > FRAUD_MAX_JOINS_PER_GROUP:
+            reasons.append("group_join_rate")
+        for joins, botlike, quick_leaves in (adder_stats, group_stats):
+            if joins < FRAUD_MIN_SAMPLE:
+                continue
+            if quick_leaves / joins > FRAUD_MAX_QUICK_LEAVE_RATIO and "quick_leaves" not in reasons:
+                reasons.append("quick_leaves")
+            if botlike / joins > FRAUD_MAX_BOTLIKE_RATIO and "botlike_usernames" not in reasons:
+                reasons.append("botlike_usernames")
+        return reasons
+
+_fraud_detector = FraudDetector()
+_fraud_alerted = {} # adder_id -> time of the last alert, so an adder is reported once per FRAUD_WINDOW
+
+def alert_fraud(bot, adder_user_id, adder_username, chat_title, reasons, held):
+    now = time.monotonic()
+    if now - _fraud_alerted.get(adder_user_id, -FRAUD_WINDOW) < FRAUD_WINDOW:
+        return
+    _fraud_alerted[adder_user_id] = now
+    text = (f"🚨 فعالیت مشکوک در افزودن عضو:\n"
+            f"کاربر: {adder_user_id} (@{adder_username or 'ندارد'})\n"
+            f"گروه: {chat_title}\n"
+            "دلایل:\n" + "\n".join(f"• {FRAUD_REASON_LABELS[reason]}" for reason in reasons))
+    reply_markup = None
+    if held:
+        text += "\n\n⏸ امتیازهای این کاربر تا تصمیم ادمین نگه داشته می‌شوند."
+        reply_markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅ آزادسازی امتیازها", callback_data=f"fraud_release_{adder_user_id}"),
+            InlineKeyboardButton("❌ رد امتیازها", callback_data=f"fraud_reject_{adder_user_id}")
+        ]])
+    else:
+        text += "\n\nℹ️ امتیازها طبق روال داده شدند (فقط هشدار)."
+    logging.warning(f"alert_fraud: Adder {adder_user_id} flagged in '{chat_title}' for {reasons} (held={held}).")
+    notify_admins(bot, "fraud_alert", text, reply_markup=reply_markup)
+
+def release_held_awards(db, adder_user_id_str):
+    # Turns the adder's held awards into ledger entries, dated when the members joined; returns
+    # (journal changes, codes issued), or ([], []) if the awards were kept because the adder is not registered
+    user_data = db.get("users", {}).get(adder_user_id_str)
+    if not user_data or not user_data.get("registered"):
+        held_count = len(db.get("held_awards", {}).get(adder_user_id_str, []))
+        logging.warning(f"release_held_awards: User {adder_user_id_str} is not registered. Keeping their {held_count} held awards.")
+        return [], []
+    held = db.get("held_awards", {}).pop(adder_user_id_str, [])
+    changes = [["del", "held_awards", adder_user_id_str]]
+    ledger = db["points_ledger"]
+    for award in held:
+        seq = ledger.append(adder_user_id_str, award["member_id"], award["group_id"], 1, award.get("timestamp"))
+        changes.append(["put", "points_ledger", seq, ledger.get(seq)])
+    user_data["points"] = ledger.balance(adder_user_id_str)
+    issued = issue_due_codes(db, adder_user_id_str)
+    for new_code_id, _ in issued:
+        changes.append(["put", "codes", str(new_code_id), db["codes"][str(new_code_id)]])
+    if issued:
+        changes.append(["set", "next_code_id", db["next_code_id"]])
+    changes.append(["put", "users", adder_user_id_str, user_data])
+    return changes, issued
+
+# --- End of Fraud Detection ---
+
+# --- Join Pipeline ---
+# track_new_member/track_left_member only enqueue events; one worker drains them in batches of up to
+# JOIN_BATCH_MAX_SIZE events or JOIN_BATCH_MAX_DELAY seconds. Joins and leaves share the queue, so a
+# group's roster changes are applied in the order Telegram delivered them.
+_join_queue = asyncio.Queue(maxsize=JOIN_QUEUE_LIMIT) # ("join", adder_id, adder_username, group_id, title, [(member_id, username)], date) / ("leave", group_id, member_id)
+_user_notification_queue = asyncio.Queue() # (chat_id, text, parse_mode), sent by one worker
+_join_pipeline_tasks = []
+
+async def enqueue_member_event(event):
+    await _join_queue.put(event)
+
+def start_join_pipeline(bot):
+    if not _join_pipeline_tasks:
+        _join_pipeline_tasks.append(asyncio.create_task(join_pipeline_worker(bot)))
+        _join_pipeline_tasks.append(asyncio.create_task(user_notification_worker(bot)))
+
+async def stop_join_pipeline(application: Application):
+    # post_stop: the bot can still send, so finish the queued batches and notifications first
+    if not _join_pipeline_tasks:
+        return
+    await _join_queue.join()
+    try:
+        await asyncio.wait_for(_user_notification_queue.join(), timeout=30)
+    except asyncio.TimeoutError:
+        logging.warning(f"stop_join_pipeline: {_user_notification_queue.qsize()} user notifications were not sent before shutdown.")
+    for task in _join_pipeline_tasks:
+        task.cancel()
+    await asyncio.gather(*_join_pipeline_tasks, return_exceptions=True)
+    _join_pipeline_tasks.clear()
+
+def queue_code_notification(user_id, code_id, milestone):
+    _user_notification_queue.put_nowait((
+        int(user_id),
+        f"🎉 تبریک! شما به {milestone} امتیاز رسیدید و یک کد جایزه جدید دریافت کردید!\n"
+        f"شماره کد جایزه شما: `{code_id}`\n"
+        "می‌توانید از بخش 'کدهای من' آن را مشاهده و برای تسویه اقدام کنید.",
+        ParseMode.MARKDOWN
+    ))
+
+async def join_pipeline_worker(bot):
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _join_queue.get()]
+        deadline = loop.time() + JOIN_BATCH_MAX_DELAY
+        while len(batch) < JOIN_BATCH_MAX_SIZE:
+            if not _join_queue.empty():
+                batch.append(_join_queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_join_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        try:
+            await apply_member_batch(bot, batch)
+        except Exception as e:
+            logging.error(f"join_pipeline_worker: Failed to apply a batch of {len(batch)} member events: {e}", exc_info=True)
+        finally:
+            for _ in batch:
+                _join_queue.task_done()
+
+async def user_notification_worker(bot):
+    while True:
+        chat_id, text, parse_mode = await _user_notification_queue.get()
+        try:
+            await bot.send_message(chat_id, text, parse_mode=parse_mode, rate_limit_args="notification")
+        except Exception as e:
+            logging.warning(f"user_notification_worker: Failed to notify user {chat_id}: {e}")
+        finally:
+            _user_notification_queue.task_done()
+
+async def apply_member_batch(bot, batch):
+    entities = set()
+    for event in batch:
+        if event[0] == "join":
+            entities.add(("user", event[1]))
+            entities.add(("group", event[3]))
+        else:
+            entities.add(("group", event[1]))
+
+    async with db_transaction(*entities) as db:
+        journal_changes = []
+        unique_members = db.setdefault("unique_members", UniqueMemberIndex())
+        ledger = db["points_ledger"]
+        new_points = {} # adder_id_str -> points earned in this batch
+        new_unique_count = 0
+        fraud_alerts = {} # adder_id -> (adder_username, chat_title, reasons, held)
+        now = int(time.time())
+
+        try:
+            # Roster changes and the dedup pass against unique_members, in arrival order
+            for event in batch:
+                if event[0] == "leave":
+                    _, group_id_str, member_id = event
+                    if FRAUD_MODE != "off":
+                        _fraud_detector.observe_leave(group_id_str, member_id, now)
+                    group_data = db.get("groups", {}).get(group_id_str)
+                    if group_data is not None and member_id in group_data.get("members", ()):
+                        group_data["members"].discard(member_id)
+                        journal_changes.append(["member_remove", group_id_str, member_id])
+                    continue
+
+                _, adder_user_id, adder_username, group_id_str, chat_title, members, date = event
+                if group_id_str not in db.get("groups", {}):
+                    if _bot_status_cache.get(int(group_id_str), ("",))[0] not in ('administrator', 'creator'):
+                        continue # The bot left or was demoted after this event was queued
+                    logging.warning(f"apply_member_batch: Group '{chat_title}' ({group_id_str}) was not in db['groups'] but bot is admin. Adding it now.")
+                    db.setdefault("groups", {})[group_id_str] = {"title": chat_title, "members": set()}
+                    journal_changes.append(["put", "groups", group_id_str, {"title": chat_title, "members": []}])
+                group_members = db["groups"][group_id_str].setdefault("members", set())
+
+                adder_user_id_str = str(adder_user_id)
+                adder_registered = bool(db.get("users", {}).get(adder_user_id_str, {}).get("registered"))
+                timestamp = int(datetime.fromisoformat(date).timestamp())
+                for member_id, member_username in members:
+                    member_id_str = str(member_id)
+                    reasons = []
+                    if FRAUD_MODE != "off":
+                        reasons = _fraud_detector.observe_join(adder_user_id, group_id_str, member_id, member_username, timestamp)
+                    if member_id_str not in unique_members:
+                        unique_members.add(member_id_str, {
+                            "first_added_by": adder_user_id,
+                            "first_added_date": date,
+                            "first_group_id": group_id_str,
+                            "first_group_title": chat_title,
+                            "added_by_username": adder_username or "ندارد",
+                            "new_member_username": member_username or "ندارد"
+                        })
+                        journal_changes.append(["put", "unique_members", member_id_str, unique_members.get(member_id_str)])
+                        new_unique_count += 1
+                        if adder_registered and reasons and FRAUD_MODE == "hold":
+                            db.setdefault("held_awards", {}).setdefault(adder_user_id_str, []).append(
+                                {"member_id": member_id, "group_id": group_id_str, "timestamp": timestamp, "reasons": reasons})
+                        elif adder_registered:
+                            seq = ledger.append(adder_user_id, member_id, group_id_str, 1, timestamp)
+                            journal_changes.append(["put", "points_ledger", seq, ledger.get(seq)])
+                            new_points[adder_user_id_str] = new_points.get(adder_user_id_str, 0) + 1
+                        if adder_registered and reasons:
+                            fraud_alerts[adder_user_id] = (adder_username, chat_title, reasons, FRAUD_MODE == "hold")
+                    if member_id not in group_members:
+                        group_members.add(member_id)
+                        journal_changes.append(["member_add", group_id_str, member_id])
+
+            # One points/code computation per adder, from the ledger balance
+            for adder_user_id_str in new_points:
+                user_data = db["users"][adder_user_id_str]
+                user_data["points"] = ledger.balance(adder_user_id_str)
+                for new_code_id, milestone in issue_due_codes(db, adder_user_id_str):
+                    journal_changes.append(["put", "codes", str(new_code_id), db["codes"][str(new_code_id)]])
+                    journal_changes.append(["set", "next_code_id", db["next_code_id"]])
+                    logging.info(f"apply_member_batch: User {adder_user_id_str} reached {milestone} points. New code {new_code_id} generated.")
+                    queue_code_notification(adder_user_id_str, new_code_id, milestone)
+                journal_changes.append(["put", "users", adder_user_id_str, user_data])
+        finally:
+            # An event failing halfway through must not leave applied mutations unpersisted. Points are
+            # re-derived from the ledger on the adder's next award (or by reconcile_points), so a balance
+            # the failed batch did not get to is caught up later.
+            for adder_user_id, (_, _, _, held) in fraud_alerts.items():
+                if held:
+                    journal_changes.append(["put", "held_awards", str(adder_user_id), db["held_awards"][str(adder_user_id)]])
+            if journal_changes:
+                commit_db_changes(db, "member_batch", journal_changes)
+        if new_points:
+            leaderboard() # Applies this batch's ledger entries to the rankings
+        for adder_user_id, (adder_username, chat_title, reasons, held) in fraud_alerts.items():
+            alert_fraud(bot, adder_user_id, adder_username, chat_title, reasons, held)
+        logging.info(f"apply_member_batch: Applied {len(batch)} member events: {new_unique_count} new unique members, {sum(new_points.values())} points to {len(new_points)} users.")
+
+# --- End of Join Pipeline ---
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != 'private':
@@ -368,7 +2512,7 @@ async def handle_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db["users"][user_id_str]["phone"] = phone_number
     db["users"][user_id_str]["user_id"] = user_id
     db["users"][user_id_str]["username"] = update.effective_user.username or "ندارد"
-    save_db(db)
+    save_db(db, ("users", user_id_str))
 
     # Check if this is part of edit flow or registration flow
     if context.user_data.get('current_edit_field') == 'phone':
@@ -390,7 +2534,7 @@ async def handle_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.text == "انصراف از ثبت نام ❌":
         if user_id_str in db["users"] and not db["users"][user_id_str].get("registered"):
             db["users"].pop(user_id_str, None)
-            save_db(db)
+            save_db(db, ("users", user_id_str))
             await update.message.reply_text("❌ ثبت نام لغو شد. برای شروع مجدد /start را بزنید.", reply_markup=ReplyKeyboardMarkup([["/start"]], resize_keyboard=True))
         else:
             await update.message.reply_text("❌ عملیات لغو شد.", reply_markup=get_main_keyboard())
@@ -402,7 +2546,7 @@ async def handle_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return WAITING_NAME
 
     db["users"][user_id_str]["name"] = name
-    save_db(db)
+    save_db(db, ("users", user_id_str))
     await update.message.reply_text(
         "✅ نام ثبت شد.\n\nلطفا شماره کارت خود را ارسال کنید (16 رقم بدون فاصله یا خط تیره):"
     )
@@ -414,7 +2558,7 @@ async def handle_card(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if update.message.text == "انصراف از ثبت نام ❌":
         if user_id_str in db["users"] and not db["users"][user_id_str].get("registered"):
-            db["users"].pop(user_id_str, None); save_db(db)
+            db["users"].pop(user_id_str, None); save_db(db, ("users", user_id_str))
             await update.message.reply_text("❌ ثبت نام لغو شد. برای شروع مجدد /start را بزنید.", reply_markup=ReplyKeyboardMarkup([["/start"]], resize_keyboard=True))
         else:
             await update.message.reply_text("❌ عملیات لغو شد.", reply_markup=get_main_keyboard())
@@ -426,7 +2570,7 @@ async def handle_card(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return WAITING_CARD
 
     db["users"][user_id_str]["card"] = card
-    save_db(db)
+    save_db(db, ("users", user_id_str))
     await update.message.reply_text(
         "✅ شماره کارت ثبت شد.\n\nلطفا شماره شبا خود را ارسال کنید (24 رقم عددی، بدون IR اولیه):"
     )
@@ -438,7 +2582,7 @@ async def handle_sheba(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if update.message.text == "انصراف از ثبت نام ❌":
         if user_id_str in db["users"] and not db["users"][user_id_str].get("registered"):
-            db["users"].pop(user_id_str, None); save_db(db)
+            db["users"].pop(user_id_str, None); save_db(db, ("users", user_id_str))
             await update.message.reply_text("❌ ثبت نام لغو شد. برای شروع مجدد /start را بزنید.", reply_markup=ReplyKeyboardMarkup([["/start"]], resize_keyboard=True))
         else:
             await update.message.reply_text("❌ عملیات لغو شد.", reply_markup=get_main_keyboard())
@@ -450,7 +2594,7 @@ async def handle_sheba(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return WAITING_SHEBA
 
     db["users"][user_id_str]["sheba"] = sheba
-    save_db(db)
+    save_db(db, ("users", user_id_str))
     await update.message.reply_text(
         "✅ شماره شبا ثبت شد.\n\nلطفا نام بانک خود را ارسال کنید (مثال: ملی، ملت، پاسارگاد):"
     )
@@ -462,7 +2606,7 @@ async def handle_bank(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if update.message.text == "انصراف از ثبت نام ❌":
         if user_id_str in db["users"] and not db["users"][user_id_str].get("registered"):
-            db["users"].pop(user_id_str, None); save_db(db)
+            db["users"].pop(user_id_str, None); save_db(db, ("users", user_id_str))
             await update.message.reply_text("❌ ثبت نام لغو شد. برای شروع مجدد /start را بزنید.", reply_markup=ReplyKeyboardMarkup([["/start"]], resize_keyboard=True))
         else:
             await update.message.reply_text("❌ عملیات لغو شد.", reply_markup=get_main_keyboard())
@@ -474,11 +2618,13 @@ async def handle_bank(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return WAITING_BANK
 
     db["users"][user_id_str]["bank"] = bank
+    if not db["users"][user_id_str].get("registered"):
+        bump_stat("registered_users")
     db["users"][user_id_str]["registered"] = True
     db["users"][user_id_str].setdefault("points", 0)
     db["users"][user_id_str].setdefault("codes", [])
     db["users"][user_id_str].setdefault("registration_date", datetime.now().isoformat())
-    save_db(db)
+    save_db(db, ("users", user_id_str))
 
     await update.message.reply_text(
         """
@@ -513,6 +2659,40 @@ async def show_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text += "💡 راهنما: به ازای هر عضوی که توسط شما به گروه‌های تحت پوشش ربات اضافه شود (و آن عضو برای اولین بار وارد سیستم شود)، ۱ امتیاز دریافت می‌کنید. هر ۱۰۰ امتیاز به طور خودکار به یک کد جایزه تبدیل می‌شود."
     await update.message.reply_text(text)
 
+def leaderboard_text(db, window, viewer_id):
+    titles = {"all": "همه زمان‌ها", "day": "۲۴ ساعت اخیر", "week": "۷ روز اخیر", "month": "۳۰ روز اخیر"}
+    is_admin = viewer_id in db.get("admins", [])
+    ranks = leaderboard()[window]
+    text = f"🥇 برترین دعوت‌کنندگان ({titles[window]}):\n\n"
+    rows = ranks.top(LEADERBOARD_SIZE * 2 if is_admin else LEADERBOARD_SIZE)
+    if not rows:
+        text += "هنوز امتیازی در این بازه ثبت نشده است.\n"
+    for position, (user_id, score) in enumerate(rows, 1):
+        user_data = db.get("users", {}).get(str(user_id), {})
+        name = user_data.get("name") or f"کاربر {user_id}"
+        if is_admin:
+            username = user_data.get("username")
+            username_part = f" @{username}" if username and username != "ندارد" else ""
+            text += f"{position}. {name}{username_part} ({user_id}): {score} امتیاز\n"
+        else:
+            text += f"{position}. {name.split()[0]}: {score} امتیاز\n" # First name only for other users' privacy
+    my_rank = ranks.rank(viewer_id)
+    if my_rank is not None:
+        text += f"\n📍 رتبه شما: {my_rank} از {len(ranks)} با {ranks.score(viewer_id)} امتیاز"
+    else:
+        text += "\n📍 شما هنوز در این بازه امتیازی ندارید."
+    return text
+
+async def show_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.type != 'private': return
+    db = load_db()
+    user_id = update.effective_user.id
+    user_data = db.get("users", {}).get(str(user_id))
+    if user_id not in db.get("admins", []) and (not user_data or not user_data.get("registered")):
+        await update.message.reply_text("❌ شما هنوز ثبت نام نکرده‌اید! لطفا ابتدا /start را بزنید.")
+        return
+    await update.message.reply_text(leaderboard_text(db, "all", user_id), reply_markup=get_leaderboard_keyboard("all"))
+
 async def show_codes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != 'private': return
     user_id_str = str(update.effective_user.id)
@@ -559,16 +2739,8 @@ async def settlement_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     unsettled_codes = []
     for code_id in user_codes_ids:
         code_info = all_codes_db.get(str(code_id))
-        if code_info and not code_info.get("settled"):
-            is_pending = False
-            for settlement_data in db.get("settlements", {}).values():
-                if str(settlement_data.get("code_id")) == str(code_id) and \
-                   str(settlement_data.get("user_id")) == user_id_str and \
-                   settlement_data.get("status") == "pending":
-                    is_pending = True
-                    break
-            if not is_pending:
-                unsettled_codes.append(code_id)
+        if code_info and not code_info.get("settled") and active_settlement_for_code(code_id) is None:
+            unsettled_codes.append(code_id)
 
     if not unsettled_codes:
         await update.message.reply_text("❌ شما در حال حاضر هیچ کد جایزه تسویه نشده و بدون درخواست فعال ندارید.")
@@ -625,7 +2797,11 @@ async def handle_support_message(update: Update, context: ContextTypes.DEFAULT_T
         "response_date": None,
         "responded_by": None
     }
-    save_db(db)
+    bump_stat("open_tickets")
+    commit_db_changes(db, "ticket_opened", [
+        ["put", "support_tickets", str(ticket_id), db["support_tickets"][str(ticket_id)]],
+        ["set", "next_ticket_id", db["next_ticket_id"]]
+    ])
 
     await update.message.reply_text(
         f"✅ درخواست پشتیبانی شما با شماره پیگیری `{ticket_id}` با موفقیت ثبت شد.\n"
@@ -634,7 +2810,6 @@ async def handle_support_message(update: Update, context: ContextTypes.DEFAULT_T
         parse_mode=ParseMode.MARKDOWN
     )
 
-    admins_to_notify = db.get("admins", [])
     user_info = db.get("users", {}).get(str(user_id), {})
     user_name_display = user_info.get('name', f"کاربر ناشناس")
     user_tg_username = user_info.get('username', 'ندارد')
@@ -647,12 +2822,7 @@ async def handle_support_message(update: Update, context: ContextTypes.DEFAULT_T
         f"برای پاسخگویی، به پنل ادمین، بخش مدیریت درخواست‌های پشتیبانی مراجعه کنید."
     ).replace("<br>", "\n")
 
-
-    for admin_id_val in admins_to_notify:
-        try:
-            await context.bot.send_message(admin_id_val, notification_text, parse_mode=ParseMode.MARKDOWN)
-        except Exception as e:
-            logging.warning(f"Failed to notify admin {admin_id_val} about new support ticket {ticket_id}: {e}")
+    notify_admins(context.bot, "support_ticket", notification_text, parse_mode=ParseMode.MARKDOWN)
 
     return ConversationHandler.END
 
@@ -738,7 +2908,7 @@ async def generic_edit_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         return EDIT_MENU
 
     db["users"][user_id_str][current_field] = processed_value
-    save_db(db)
+    save_db(db, ("users", user_id_str))
     await update.message.reply_text(success_message, reply_markup=get_edit_keyboard())
     context.user_data.pop('current_edit_field', None)
     return EDIT_MENU
@@ -847,13 +3017,8 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ شما دسترسی ادمین ندارید!")
         return
 
-    await update.message.reply_text("⏳ در حال به‌روزرسانی اطلاعات گروه‌ها... این عملیات ممکن است چند لحظه طول بکشد.")
-    try:
-        await update_groups_list_simplified(context.bot)
-        await update.message.reply_text("🔧 پنل مدیریت ربات:", reply_markup=get_admin_keyboard())
-    except Exception as e:
-        logging.error(f"Error during admin panel group update: {e}", exc_info=True)
-        await update.message.reply_text(f"خطا در به‌روزرسانی اطلاعات گروه: {e}. لطفاً لاگ‌ها را بررسی کنید.", reply_markup=get_admin_keyboard())
+    freshness = revalidate_groups_if_stale(context.bot, db)
+    await update.message.reply_text(f"🔧 پنل مدیریت ربات:\n{freshness}", reply_markup=get_admin_keyboard())
 
 
 async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -863,30 +3028,47 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ شما دسترسی ادمین ندارید!")
         return
 
-    await update.message.reply_text("⏳ در حال جمع‌آوری و به‌روزرسانی آمار...")
-    await update_groups_list_simplified(context.bot)
-    db = load_db()
+    freshness = revalidate_groups_if_stale(context.bot, db)
+    text = admin_stats_text(db) + freshness + outbound_metrics_text(context.bot)
+    await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=get_admin_stats_keyboard())
+
+def outbound_metrics_text(bot):
+    scheduler = getattr(bot, "rate_limiter", None)
+    if not isinstance(scheduler, OutboundScheduler):
+        return ""
+    metrics = scheduler.metrics()
+    depth, avg_wait = metrics["queue_depth"], metrics["avg_wait"]
+    return (
+        f"\n📤 صف ارسال: {sum(depth.values())} درخواست در انتظار "
+        f"(پاسخ {depth['interactive']}، اعلان {depth['notification']}، انبوه {depth['bulk']})\n"
+        f"⏱ میانگین انتظار (ثانیه): پاسخ {avg_wait['interactive']:.2f}، اعلان {avg_wait['notification']:.2f}، انبوه {avg_wait['bulk']:.2f}"
+        f" | محدودیت ارسال تلگرام: {metrics['retry_after']} بار"
+    )
 
+def admin_stats_text(db):
+    # Built from maintained counters only, so it costs the same for any database size
+    counters = stats_counters()
     total_users_interacted = len(db.get("users", {}))
-    registered_users = sum(1 for u_data in db.get("users", {}).values() if u_data.get("registered"))
+    registered_users = counters["registered_users"]
     total_codes = len(db.get("codes", {}))
-    pending_settlements = sum(1 for s_data in db.get("settlements", {}).values() if s_data.get("status") == "pending")
-    open_tickets = sum(1 for t_data in db.get("support_tickets", {}).values() if t_data.get("status") == "open")
+    pending_settlements = count_settlements_with_status("pending")
+    open_tickets = counters["open_tickets"]
     active_groups_in_db = len(db.get("groups", {}))
 
-    text = f"""
+    return f"""
 📊 **آمار کلی ربات:**
 
 👤 تعداد کل کاربرانی که با ربات تعامل داشته‌اند (استارت زده‌اند): {total_users_interacted}
 ✅ کاربران با ثبت نام تکمیل شده: {registered_users}
 👥 تعداد اعضای منحصر به فرد اضافه شده به گروه‌ها (توسط همه): {len(db.get("unique_members", {}))}
+📒 ثبت‌های دفتر امتیاز: {len(db.get("points_ledger", ()))}
+⏸ امتیازهای نگه‌داشته‌شده برای بررسی تقلب: {sum(len(held) for held in db.get("held_awards", {}).values())}
 🏢 تعداد گروه‌هایی که ربات حداقل یکبار در آنها ادمین شده و هنوز خارج نشده: {active_groups_in_db}
 🎫 کل کدهای جایزه صادر شده: {total_codes}
 💳 درخواست‌های تسویه در انتظار تایید ادمین: {pending_settlements}
 📮 تیکت‌های پشتیبانی باز و در انتظار پاسخ: {open_tickets}
 🔗 تعداد لینک‌های تبلیغاتی ثبت شده: {len(db.get("promotional_links", []))}
 """
-    await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
 
 
 async def export_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -955,10 +3137,7 @@ async def show_active_settlements(update: Update, context: ContextTypes.DEFAULT_
     db = load_db()
     if user_id not in db.get("admins", []): return
 
-    pending_settlements = []
-    for settle_id, settlement_data in db.get("settlements", {}).items():
-        if settlement_data.get("status") == "pending":
-            pending_settlements.append((settle_id, settlement_data))
+    pending_settlements = settlements_with_status("pending")
 
     if not pending_settlements:
         await update.message.reply_text("❌ در حال حاضر هیچ درخواست تسویه فعالی برای بررسی وجود ندارد.")
@@ -1096,7 +3275,7 @@ async def handle_add_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if full_link not in db.get("promotional_links", []):
         db.setdefault("promotional_links", []).append(full_link)
-        save_db(db)
+        save_db(db, (DB_META, "promotional_links"))
         await update.message.reply_text(f"✅ لینک '{full_link}' با موفقیت به لیست لینک‌های تبلیغاتی اضافه شد.")
     else:
         await update.message.reply_text("❌ این لینک قبلاً در لیست موجود است.")
@@ -1158,37 +3337,23 @@ async def handle_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db = load_db()
     message_to_broadcast = update.message.text
     active_groups_map = db.get("groups", {})
-    sent_count = 0
-    failed_count = 0
-    failed_group_details = []
 
     if not active_groups_map:
         await update.message.reply_text("❌ هیچ گروهی برای ارسال پیام یافت نشد (مجدداً بررسی شد).", reply_markup=get_admin_keyboard())
         return ConversationHandler.END
 
-    await update.message.reply_text(f"⏳ در حال ارسال پیام به {len(active_groups_map)} گروه. این عملیات ممکن است زمان‌بر باشد...")
-
-    for group_id_str, group_data in active_groups_map.items():
-        group_title = group_data.get("title", group_id_str)
-        try:
-            await context.bot.send_message(int(group_id_str), message_to_broadcast)
-            sent_count += 1
-            logging.info(f"Broadcast sent successfully to group {group_title} ({group_id_str})")
-        except Exception as e:
-            failed_count += 1
-            logging.error(f"Failed to send broadcast to group {group_title} ({group_id_str}): {e}")
-            failed_group_details.append(f"- گروه '{group_title}' (ID: {group_id_str}): {type(e).__name__}")
-        await asyncio.sleep(0.3)
-
-    result_message = f"📣 **نتیجه ارسال پیام همگانی:**\n\n"
-    result_message += f"✅ با موفقیت به {sent_count} گروه ارسال شد.\n"
-    if failed_count > 0:
-        result_message += f"❌ ارسال به {failed_count} گروه ناموفق بود.\n"
-        if failed_group_details:
-            result_message += "\nجزئیات گروه‌های ناموفق:\n" + "\n".join(failed_group_details)
-            result_message += "\n\n(دلایل رایج عدم موفقیت: ربات دیگر در گروه عضو نیست، ادمین نیست، یا از گروه اخراج شده است. جزئیات بیشتر در لاگ‌های سرور ربات موجود است.)"
+    job_id = create_broadcast_job(db, update.effective_user.id, message_to_broadcast, list(active_groups_map))
+    job = db["broadcasts"][job_id]
+    status_message = await update.message.reply_text(broadcast_status_text(job_id, job))
+    job["status_chat_id"] = status_message.chat_id
+    job["status_message_id"] = status_message.message_id
+    save_db(db, ("broadcasts", job_id))
+    start_broadcast_job(context.bot, job_id)
 
-    await update.message.reply_text(result_message, reply_markup=get_admin_keyboard(), parse_mode=ParseMode.MARKDOWN)
+    await update.message.reply_text(
+        f"⏳ ارسال پیام به {len(active_groups_map)} گروه در پس‌زمینه آغاز شد. پیشرفت کار در پیام بالا نمایش داده می‌شود و می‌توانید در این مدت از پنل استفاده کنید.",
+        reply_markup=get_admin_keyboard()
+    )
     return ConversationHandler.END
 
 async def manage_admins_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1227,25 +3392,24 @@ async def list_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
         escaped = text_to_escape.replace("_", "\\_").replace("*", "\\*").replace("`", "\\`")
         return escaped
 
+    profiles = await get_admin_profiles(context.bot, admin_ids)
     for i, admin_id_val in enumerate(admin_ids, 1):
         name_display_raw = f"کاربر با شناسه"  # Default if get_chat fails or no name
         username_raw = ""
-        try:
-            
-            chat = await context.bot.get_chat(int(admin_id_val))
-            current_name = chat.full_name or chat.first_name
+        profile = profiles.get(admin_id_val)
+        if profile:
+            current_name, current_username = profile
             if current_name: # Ensure there's some name
                 name_display_raw = current_name
-            elif not current_name and chat.username: # If no name but username exists
-                 name_display_raw = f"@{chat.username}" # Use username as name
+            elif not current_name and current_username: # If no name but username exists
+                 name_display_raw = f"@{current_username}" # Use username as name
             else: # If no name and no username, use the ID fallback
                 name_display_raw = f"کاربر {admin_id_val}"
 
 
-            if chat.username:
-                username_raw = chat.username
-        except Exception as e:
-            logging.warning(f"Could not fetch info for admin ID {admin_id_val}: {e}")
+            if current_username:
+                username_raw = current_username
+        else:
             name_display_raw = f"کاربر {admin_id_val}" # Fallback if chat fetch fails
 
         safe_name_display = escape_markdown_v1(name_display_raw)
@@ -1298,7 +3462,7 @@ async def handle_add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if new_admin_id not in db.get("admins", []):
             db.setdefault("admins", []).append(new_admin_id)
-            save_db(db)
+            save_db(db, (DB_META, "admins"))
             await update.message.reply_text(f"✅ کاربر با شناسه `{new_admin_id}` با موفقیت به لیست ادمین‌ها اضافه شد.")
         else:
             await update.message.reply_text("❌ این کاربر در حال حاضر جزو ادمین‌های ربات می‌باشد.")
@@ -1331,18 +3495,18 @@ async def remove_admin_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if not text_to_escape: return ""
         return text_to_escape # Usually not needed for button text unless it's very long or complex
 
+    profiles = await get_admin_profiles(context.bot, removable_admins)
     for i, admin_id_val in enumerate(removable_admins):
         name_display = f"ادمین {i+1}"
         username_display_part = ""
-        try:
-            chat = await context.bot.get_chat(int(admin_id_val)) # Ensure int
-            current_name = chat.full_name or chat.first_name
+        profile = profiles.get(admin_id_val)
+        if profile: # Keep default name_display if get_chat failed
+            current_name, current_username = profile
             if current_name: name_display = current_name
-            elif chat.username: name_display = f"@{chat.username}"
+            elif current_username: name_display = f"@{current_username}"
             else: name_display = f"کاربر {admin_id_val}"
 
-            if chat.username: username_display_part = f" (@{chat.username})"
-        except: pass # Keep default name_display if get_chat fails
+            if current_username: username_display_part = f" (@{current_username})"
 
         button_text = f"حذف: {escape_text_for_button(name_display)} (ID: {admin_id_val}){escape_text_for_button(username_display_part)}"
         # Truncate button text if too long, Telegram has limits
@@ -1375,124 +3539,39 @@ async def track_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_title = update.effective_chat.title or f"گروه {chat_id}"
 
     try:
-        bot_member = await context.bot.get_chat_member(chat_id, context.bot.id)
-        if bot_member.status not in ['administrator', 'creator']:
+        bot_status = await get_bot_status(context.bot, chat_id)
+        if bot_status not in ['administrator', 'creator']:
             logging.info(f"track_new_member: Bot is not admin in group '{chat_title}' ({chat_id}). Ignoring new members.")
             return
     except Exception as e:
         logging.error(f"track_new_member: Could not verify bot admin status in chat {chat_id}: {e}. Ignoring.")
         return
 
-    db = load_db()
-    group_id_str = str(chat_id)
-
-    if group_id_str not in db.get("groups", {}):
-        logging.warning(f"track_new_member: Group '{chat_title}' ({group_id_str}) was not in db['groups'] but bot is admin. Adding it now.")
-        db.setdefault("groups", {})[group_id_str] = {"title": chat_title, "members": []}
-
-    group_data = db["groups"].get(group_id_str, {"title": chat_title, "members": []})
-    group_members_list = group_data.get("members", [])
-
-
-    points_awarded_this_event = 0
-    newly_added_to_group_db = False
-    changes_made_to_db = False # Flag to save DB once at the end
-
-    for new_member in update.message.new_chat_members:
-        if new_member.is_bot:
-            logging.info(f"track_new_member: Ignoring new bot member {new_member.id} in group {chat_id}.")
-            continue
-
-        new_member_id_str = str(new_member.id)
-
-        if new_member_id_str not in db.get("unique_members", {}):
-            db.setdefault("unique_members", {})[new_member_id_str] = {
-                "first_added_by": adder_user_id,
-                "first_added_date": datetime.now().isoformat(),
-                "first_group_id": group_id_str,
-                "first_group_title": chat_title,
-                "added_by_username": update.effective_user.username or "ندارد",
-                "new_member_username": new_member.username or "ندارد"
-            }
-            changes_made_to_db = True
-            logging.info(f"track_new_member: New unique member {new_member_id_str} added by {adder_user_id} to system via group {chat_id}.")
-
-            adder_user_id_str = str(adder_user_id)
-            if adder_user_id_str in db.get("users", {}) and db["users"][adder_user_id_str].get("registered"):
-                db["users"][adder_user_id_str]["points"] = db["users"][adder_user_id_str].get("points", 0) + 1
-                points_awarded_this_event += 1
-                changes_made_to_db = True
-                current_points = db["users"][adder_user_id_str]["points"]
-                logging.info(f"track_new_member: User {adder_user_id_str} awarded 1 point. Total points: {current_points}.")
-
-                if current_points > 0 and current_points % 100 == 0:
-                    new_code_id = db.get("next_code_id", 1)
-                    db["next_code_id"] = new_code_id + 1
-                    db.setdefault("codes", {})[str(new_code_id)] = {
-                        "user_id": adder_user_id, "date": datetime.now().isoformat(), "settled": False
-                    }
-                    db["users"][adder_user_id_str].setdefault("codes", []).append(new_code_id)
-                    changes_made_to_db = True
-                    logging.info(f"track_new_member: User {adder_user_id_str} reached {current_points} points. New code {new_code_id} generated.")
-                    try:
-                        await context.bot.send_message(
-                            adder_user_id,
-                            f"🎉 تبریک! شما به {current_points} امتیاز رسیدید و یک کد جایزه جدید دریافت کردید!\n"
-                            f"شماره کد جایزه شما: `{new_code_id}`\n"
-                            "می‌توانید از بخش 'کدهای من' آن را مشاهده و برای تسویه اقدام کنید.",
-                            parse_mode=ParseMode.MARKDOWN
-                        )
-                    except Exception as e:
-                        logging.warning(f"track_new_member: Failed to notify user {adder_user_id} about new code {new_code_id}: {e}")
-            else:
-                logging.info(f"track_new_member: Adder {adder_user_id} is not registered in the bot. No points awarded for adding {new_member_id_str}.")
-        else:
-            logging.info(f"track_new_member: Member {new_member_id_str} was already in unique_members. No points for this addition.")
-
-        if new_member_id_str not in group_members_list:
-            group_members_list.append(new_member_id_str)
-            newly_added_to_group_db = True # This specific flag is for group's local list
-            changes_made_to_db = True
-
-
-    if newly_added_to_group_db: # Only update if group member list changed
-        if group_id_str in db.get("groups", {}):
-             db["groups"][group_id_str]["members"] = group_members_list
-        else:
-             db.setdefault("groups", {})[group_id_str] = {"title": chat_title, "members": group_members_list}
-        logging.info(f"track_new_member: Updated member list for group {group_id_str}.")
-
-    if changes_made_to_db:
-        save_db(db)
-        if points_awarded_this_event > 0:
-             logging.info(f"track_new_member: Finished processing. User {adder_user_id} received a total of {points_awarded_this_event} points in this event for group {chat_id}.")
+    members = [(member.id, member.username) for member in update.message.new_chat_members if not member.is_bot]
+    if members:
+        await enqueue_member_event((
+            "join", adder_user_id, update.effective_user.username, str(chat_id), chat_title, members, datetime.now().isoformat()
+        ))
 
 
 async def track_left_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.message.left_chat_member:
         return
 
-    db = load_db()
     group_id_str = str(update.effective_chat.id)
     left_member = update.message.left_chat_member
 
     if left_member.is_bot and left_member.id == context.bot.id:
-        if group_id_str in db.get("groups", {}):
-            del db["groups"][group_id_str]
-            save_db(db)
-            logging.info(f"track_left_member: Bot itself left/was kicked from group {group_id_str}. Removed from db['groups'].")
+        set_cached_bot_status(update.effective_chat.id, "left")
+        async with db_transaction(("group", group_id_str)) as db:
+            if group_id_str in db.get("groups", {}):
+                del db["groups"][group_id_str]
+                save_db(db, ("groups", group_id_str))
+                logging.info(f"track_left_member: Bot itself left/was kicked from group {group_id_str}. Removed from db['groups'].")
         return
 
-    left_member_id_str = str(left_member.id)
-    if group_id_str in db.get("groups", {}) and "members" in db["groups"][group_id_str]:
-        if left_member_id_str in db["groups"][group_id_str]["members"]:
-            db["groups"][group_id_str]["members"].remove(left_member_id_str)
-            save_db(db)
-            logging.info(f"track_left_member: Member {left_member_id_str} removed from local member list of group {group_id_str}.")
-        else:
-            logging.info(f"track_left_member: Member {left_member_id_str} left group {group_id_str}, but was not in local member list.")
-    else:
-        logging.info(f"track_left_member: Group {group_id_str} not in db or has no member list. Cannot remove left member {left_member_id_str}.")
+    # Roster updates go through the join pipeline so they stay ordered with queued joins
+    await enqueue_member_event(("leave", group_id_str, left_member.id))
 
 
 # --- Admin Settlement Photo Handling ---
@@ -1531,7 +3610,7 @@ async def handle_admin_settlement_receipt(update: Update, context: ContextTypes.
     if settlement_id in db.get("settlements", {}):
         db["settlements"][settlement_id]["receipt_info"] = receipt_file_data
         db["settlements"][settlement_id]["receipt_submission_date"] = datetime.now().isoformat()
-        save_db(db)
+        commit_db_changes(db, "settlement_receipt", [["put", "settlements", settlement_id, db["settlements"][settlement_id]]])
     else:
         await update.message.reply_text("خطای بحرانی: درخواست تسویه در دیتابیس یافت نشد. با توسعه‌دهنده تماس بگیرید.", reply_markup=get_admin_keyboard())
         context.user_data.clear()
@@ -1618,54 +3697,48 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data.startswith("settle_") and not data.startswith("settle_approve_") and not data.startswith("settle_reject_") and not data.startswith("settle_admin_"):
         code_id_to_settle = data.split("settle_")[1]
-        user_data = db.get("users", {}).get(user_id_str)
+        async with db_transaction(("user", user_id), ("code", code_id_to_settle)):
+            user_data = db.get("users", {}).get(user_id_str)
 
-        if not user_data or not user_data.get("registered"):
-            await query.edit_message_text("❌ برای درخواست تسویه، ابتدا باید از طریق /start ثبت نام کنید.")
-            return
+            if not user_data or not user_data.get("registered"):
+                await query.edit_message_text("❌ برای درخواست تسویه    ، ابتدا باید از طریق /start ثبت نام کنید.")
+                return
 
-        all_codes_db = db.get("codes", {})
-        code_info = all_codes_db.get(str(code_id_to_settle))
+            all_codes_db = db.get("codes", {})
+            code_info = all_codes_db.get(str(code_id_to_settle))
 
-        if not code_info or str(code_info.get("user_id")) != user_id_str:
-            await query.edit_message_text(f"❌ کد جایزه شماره `{code_id_to_settle}` متعلق به شما نیست یا یافت نشد.", parse_mode=ParseMode.MARKDOWN)
-            return
-        if code_info.get("settled"):
-            await query.edit_message_text(f"❌ کد جایزه شماره `{code_id_to_settle}` قبلاً تسویه شده است.", parse_mode=ParseMode.MARKDOWN)
-            return
+            if not code_info or str(code_info.get("user_id")) != user_id_str:
+                await query.edit_message_text(f"❌ کد جایزه شماره `{code_id_to_settle}` متعلق به شما نیست یا یافت نشد.", parse_mode=ParseMode.MARKDOWN)
+                return
+            if code_info.get("settled"):
+                await query.edit_message_text(f"❌ کد جایزه شماره `{code_id_to_settle}` قبلاً تسویه شده است.", parse_mode=ParseMode.MARKDOWN)
+                return
 
-        for settlement_id_existing, settlement_data_existing in db.get("settlements", {}).items():
-            if str(settlement_data_existing.get("code_id")) == str(code_id_to_settle) and \
-               str(settlement_data_existing.get("user_id")) == user_id_str and \
-               settlement_data_existing.get("status") == "pending":
+            active_settlement_id = active_settlement_for_code(code_id_to_settle)
+            if active_settlement_id is not None and str(db["settlements"][active_settlement_id].get("user_id")) == user_id_str:
                 await query.edit_message_text(f"⚠️ شما قبلاً برای کد جایزه شماره `{code_id_to_settle}` یک درخواست تسویه فعال ثبت کرده‌اید. لطفاً منتظر بررسی ادمین بمانید.", parse_mode=ParseMode.MARKDOWN)
                 return
 
-        settlement_id_new = f"{user_id_str}_{code_id_to_settle}_{int(datetime.now().timestamp())}"
-        db.setdefault("settlements", {})[settlement_id_new] = {
-            "user_id": user_id, "code_id": code_id_to_settle,
-            "date": datetime.now().isoformat(), "status": "pending",
-            "receipt_info": None
-        }
-        save_db(db)
+            settlement_id_new = f"{user_id_str}_{code_id_to_settle}_{int(datetime.now().timestamp())}"
+            put_settlement(db, settlement_id_new, {
+                "user_id": user_id, "code_id": code_id_to_settle,
+                "date": datetime.now().isoformat(), "status": "pending",
+                "receipt_info": None
+            })
+            commit_db_changes(db, "settlement_requested", [["put", "settlements", settlement_id_new, db["settlements"][settlement_id_new]]])
 
-        await query.edit_message_text(f"✅ درخواست تسویه شما برای کد جایزه شماره `{code_id_to_settle}` با موفقیت ثبت شد. نتیجه بررسی توسط ادمین از طریق همین ربات به شما اطلاع داده خواهد شد.", parse_mode=ParseMode.MARKDOWN)
+            await query.edit_message_text(f"✅ درخواست تسویه شما برای کد جایزه شماره `{code_id_to_settle}` با موفقیت ثبت شد. نتیجه بررسی توسط ادمین از طریق همین ربات به شما اطلاع داده خواهد شد.", parse_mode=ParseMode.MARKDOWN)
 
-        admins_to_notify = db.get("admins", [])
-        admin_notification_text = (
-            f"🔔 **درخواست تسویه حساب جدید دریافت شد!** 🔔\n\n"
-            f"کد جایزه: `{code_id_to_settle}`\n"
-            f"از طرف کاربر: {user_data.get('name', 'نامشخص')} (ID: `{user_id_str}`)\n"
-            f"یوزرنیم تلگرام: @{user_data.get('username', 'ندارد')}\n"
-            f"شماره تماس کاربر: `{user_data.get('phone', 'ثبت نشده')}`\n\n"
-            f"برای بررسی و پردازش، به پنل ادمین، بخش مدیریت درخواست‌های تسویه مراجعه کنید."
-        )
-        for admin_id_val in admins_to_notify:
-            try:
-                await context.bot.send_message(admin_id_val, admin_notification_text, parse_mode=ParseMode.MARKDOWN)
-            except Exception as e:
-                logging.warning(f"Failed to notify admin {admin_id_val} about new settlement request for code {code_id_to_settle}: {e}")
-        return
+            admin_notification_text = (
+                f"🔔 **درخواست تسویه حساب جدید دریافت شد!** 🔔\n\n"
+                f"کد جایزه: `{code_id_to_settle}`\n"
+                f"از طرف کاربر: {user_data.get('name', 'نامشخص')} (ID: `{user_id_str}`)\n"
+                f"یوزرنیم تلگرام: @{user_data.get('username', 'ندارد')}\n"
+                f"شماره تماس کاربر: `{user_data.get('phone', 'ثبت نشده')}`\n\n"
+                f"برای بررسی و پردازش، به پنل ادمین، بخش مدیریت درخواست‌های تسویه مراجعه کنید."
+            )
+            notify_admins(context.bot, "settlement_request", admin_notification_text, parse_mode=ParseMode.MARKDOWN)
+            return
 
     elif data == "cancel_settlement_selection":
         await query.edit_message_text("انتخاب کد برای تسویه لغو شد. برای تلاش مجدد، از منوی اصلی اقدام کنید.")
@@ -1678,102 +3751,121 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         action_type = "approve" if data.startswith("settle_approve_") else "reject"
         settlement_id_to_act = data.split("_", 2)[2]
-        settlement_info = db.get("settlements", {}).get(settlement_id_to_act)
+        async with db_transaction(("settlement", settlement_id_to_act)):
+            settlement_info = db.get("settlements", {}).get(settlement_id_to_act)
 
-        if not settlement_info:
-            await query.edit_message_text("❌ این درخواست تسویه یافت نشد. ممکن است قبلاً پردازش یا حذف شده باشد.")
-            return
-        if settlement_info.get("status") != "pending": # Or "awaiting_receipt" if you had such a state
-            await query.edit_message_text(f"⚠️ این درخواست تسویه قبلاً در وضعیت '{settlement_info.get('status')}' بوده و نمی‌تواند مجدداً پردازش شود. وضعیت فعلی: {settlement_info.get('status')}.")
-            return
-
-        requesting_user_id = settlement_info.get("user_id")
-        code_id_affected = str(settlement_info.get("code_id"))
-
-        if action_type == "approve":
-            # Ensure there's receipt info before approving, if it's mandatory
-            if not settlement_info.get("receipt_info"):
-                await query.edit_message_text("❌ خطا: فیش واریزی برای این تسویه ثبت نشده است. لطفاً ابتدا فیش را ارسال و سپس تایید کنید.")
-                # Potentially resend the original settlement detail message if needed
-                # This state implies the admin might have clicked approve on the *initial* detail message, not the one after receipt submission.
-                # It's better if "approve" is only available after receipt is logged.
-                # For now, we just block.
+            if not settlement_info:
+                await query.edit_message_text("❌ این درخواست تسویه یافت نشد. ممکن است قبلاً پردازش یا حذف شده باشد.")
+                return
+            if settlement_info.get("status") != "pending": # Or "awaiting_receipt" if you had such a state
+                await query.edit_message_text(f"⚠️ این درخواست تسویه قبلاً در وضعیت '{settlement_info.get('status')}' بوده و نمی‌تواند مجدداً پردازش شود. وضعیت فعلی: {settlement_info.get('status')}.")
                 return
 
+            requesting_user_id = settlement_info.get("user_id")
+            code_id_affected = str(settlement_info.get("code_id"))
+
+            if action_type == "approve":
+                # Ensure there's receipt info before approving, if it's mandatory
+                if not settlement_info.get("receipt_info"):
+                    await query.edit_message_text("❌ خطا: فیش واریزی برای این تسویه ثبت نشده است. لطفاً ابتدا فیش را ارسال و سپس تایید کنید.")
+                    # Potentially resend the original settlement detail message if needed
+                    # This state implies the admin might have clicked approve on the *initial* detail message, not the one after receipt submission.
+                    # It's better if "approve" is only available after receipt is logged.
+                    # For now, we just block.
+                    return
+
+
+                previous_fields = {field: settlement_info.get(field) for field in ("status", "completed_date", "processed_by")}
+                update_settlement(db, settlement_id_to_act, status="completed", completed_date=datetime.now().isoformat(), processed_by=user_id)
+                approval_changes = [["put", "settlements", settlement_id_to_act, db["settlements"][settlement_id_to_act]]]
+                if code_id_affected in db.get("codes", {}):
+                    db["codes"][code_id_affected]["settled"] = True
+                    approval_changes.append(["put", "codes", code_id_affected, db["codes"][code_id_affected]])
+                else:
+                    logging.error(f"Code {code_id_affected} not found in codes DB during settlement approval for {settlement_id_to_act}")
 
-            db["settlements"][settlement_id_to_act]["status"] = "completed"
-            db["settlements"][settlement_id_to_act]["completed_date"] = datetime.now().isoformat()
-            db["settlements"][settlement_id_to_act]["processed_by"] = user_id
-            if code_id_affected in db.get("codes", {}):
-                db["codes"][code_id_affected]["settled"] = True
-            else:
-                logging.error(f"Code {code_id_affected} not found in codes DB during settlement approval for {settlement_id_to_act}")
-
-            save_db(db)
-            await query.edit_message_text(f"✅ درخواست تسویه برای کد `{code_id_affected}` با موفقیت **تایید شد** و به عنوان 'تسویه شده' علامت‌گذاری گردید.", parse_mode=ParseMode.MARKDOWN)
-
-            try:
-                receipt_info = settlement_info.get("receipt_info")
-                approval_caption = (
-                    f"🎉 خبر خوب! درخواست تسویه شما برای کد جایزه شماره `{code_id_affected}` **تأیید شد**.\n"
-                    "مبلغ مربوطه واریز گردید. فیش پیوست را مشاهده کنید."
-                )
-                fallback_message = (
-                     f"🎉 خبر خوب! درخواست تسویه شما برای کد جایزه شماره `{code_id_affected}` **تأیید شد**.\n"
-                     "مبلغ مربوطه واریز شد."
-                )
+                durable = commit_db_changes(db, "settlement_completed", approval_changes)
+                if durable is not None:
+                    try:
+                        await durable # Persist the payout before confirming it to anyone
+                    except Exception as e:
+                        # Put the request back to pending so the admin can approve it again once storage recovers
+                        logging.error(f"Settlement approval for code {code_id_affected} could not be persisted: {e}")
+                        update_settlement(db, settlement_id_to_act, **previous_fields)
+                        revert_changes = [["put", "settlements", settlement_id_to_act, db["settlements"][settlement_id_to_act]]]
+                        if code_id_affected in db.get("codes", {}):
+                            db["codes"][code_id_affected]["settled"] = False
+                            revert_changes.append(["put", "codes", code_id_affected, db["codes"][code_id_affected]])
+                        commit_db_changes(db, "settlement_approval_reverted", revert_changes)
+                        await query.edit_message_text(f"⚠️ خطا در ذخیره تایید تسویه کد `{code_id_affected}`. درخواست همچنان در انتظار است و به کاربر اطلاعی داده نشد؛ لطفاً دوباره تلاش کنید.", parse_mode=ParseMode.MARKDOWN)
+                        return
+                await query.edit_message_text(f"✅ درخواست تسویه برای کد `{code_id_affected}` با موفقیت **تایید شد** و به عنوان 'تسویه شده' علامت‌گذاری گردید.", parse_mode=ParseMode.MARKDOWN)
 
-                if receipt_info and receipt_info.get("file_id"):
-                    file_id = receipt_info.get("file_id")
-                    file_type = receipt_info.get("type")
+                try:
+                    receipt_info = settlement_info.get("receipt_info")
+                    approval_caption = (
+                        f"🎉 خبر خوب! درخواست تسویه شما برای کد جایزه شماره `{code_id_affected}` **تأیید شد**.\n"
+                        "مبلغ مربوطه واریز گردید. فیش پیوست را مشاهده کنید."
+                    )
+                    fallback_message = (
+                         f"🎉 خبر خوب! درخواست تسویه شما برای کد جایزه شماره `{code_id_affected}` **تأیید شد**.\n"
+                         "مبلغ مربوطه واریز شد."
+                    )
 
-                    if file_type == "photo":
-                        await context.bot.send_photo(
-                            chat_id=requesting_user_id,
-                            photo=file_id,
-                            caption=approval_caption,
-                            parse_mode=ParseMode.MARKDOWN
-                        )
-                    elif file_type == "document":
-                        await context.bot.send_document(
-                            chat_id=requesting_user_id,
-                            document=file_id,
-                            caption=approval_caption,
-                            parse_mode=ParseMode.MARKDOWN
-                        )
+                    if receipt_info and receipt_info.get("file_id"):
+                        file_id = receipt_info.get("file_id")
+                        file_type = receipt_info.get("type")
+
+                        if file_type == "photo":
+                            await context.bot.send_photo(
+                                chat_id=requesting_user_id,
+                                photo=file_id,
+                                caption=approval_caption,
+                                parse_mode=ParseMode.MARKDOWN,
+                                rate_limit_args="notification"
+                            )
+                        elif file_type == "document":
+                            await context.bot.send_document(
+                                chat_id=requesting_user_id,
+                                document=file_id,
+                                caption=approval_caption,
+                                parse_mode=ParseMode.MARKDOWN,
+                                rate_limit_args="notification"
+                            )
+                        else:
+                             await context.bot.send_message(
+                                requesting_user_id,
+                                fallback_message + " (فیش پیوست نشد)",
+                                parse_mode=ParseMode.MARKDOWN,
+                                rate_limit_args="notification"
+                            )
                     else:
-                         await context.bot.send_message(
+                        logging.warning(f"Approving settlement {settlement_id_to_act} for user {requesting_user_id} WITHOUT a receipt_info file_id, though receipt_info might exist: {receipt_info}")
+                        await context.bot.send_message(
                             requesting_user_id,
-                            fallback_message + " (فیش پیوست نشد)",
-                            parse_mode=ParseMode.MARKDOWN
+                            fallback_message,
+                            parse_mode=ParseMode.MARKDOWN,
+                            rate_limit_args="notification"
                         )
-                else:
-                    logging.warning(f"Approving settlement {settlement_id_to_act} for user {requesting_user_id} WITHOUT a receipt_info file_id, though receipt_info might exist: {receipt_info}")
+                except Exception as e:
+                    logging.warning(f"Failed to notify user {requesting_user_id} about settlement approval for code {code_id_affected}: {e}")
+
+
+            elif action_type == "reject":
+                update_settlement(db, settlement_id_to_act, status="rejected", rejected_date=datetime.now().isoformat(), processed_by=user_id)
+                commit_db_changes(db, "settlement_rejected", [["put", "settlements", settlement_id_to_act, db["settlements"][settlement_id_to_act]]])
+                await query.edit_message_text(f"❌ درخواست تسویه برای کد `{code_id_affected}` **رد شد**.", parse_mode=ParseMode.MARKDOWN)
+                try:
                     await context.bot.send_message(
                         requesting_user_id,
-                        fallback_message,
-                        parse_mode=ParseMode.MARKDOWN
+                        f"⚠️ متاسفانه درخواست تسویه شما برای کد جایزه شماره `{code_id_affected}` توسط ادمین **رد شد**.\n"
+                        "در صورت داشتن سوال یا اعتراض، لطفاً از طریق بخش پشتیبانی با ما تماس بگیرید.",
+                        parse_mode=ParseMode.MARKDOWN,
+                        rate_limit_args="notification"
                     )
-            except Exception as e:
-                logging.warning(f"Failed to notify user {requesting_user_id} about settlement approval for code {code_id_affected}: {e}")
-
-
-        elif action_type == "reject":
-            db["settlements"][settlement_id_to_act]["status"] = "rejected"
-            db["settlements"][settlement_id_to_act]["rejected_date"] = datetime.now().isoformat()
-            db["settlements"][settlement_id_to_act]["processed_by"] = user_id
-            save_db(db)
-            await query.edit_message_text(f"❌ درخواست تسویه برای کد `{code_id_affected}` **رد شد**.", parse_mode=ParseMode.MARKDOWN)
-            try:
-                await context.bot.send_message(
-                    requesting_user_id,
-                    f"⚠️ متاسفانه درخواست تسویه شما برای کد جایزه شماره `{code_id_affected}` توسط ادمین **رد شد**.\n"
-                    "در صورت داشتن سوال یا اعتراض، لطفاً از طریق بخش پشتیبانی با ما تماس بگیرید.",
-                    parse_mode=ParseMode.MARKDOWN
-                )
-            except Exception as e:
-                logging.warning(f"Failed to notify user {requesting_user_id} about settlement rejection for code {code_id_affected}: {e}")
-        return
+                except Exception as e:
+                    logging.warning(f"Failed to notify user {requesting_user_id} about settlement rejection for code {code_id_affected}: {e}")
+            return
 
     elif data == "admin_settle_cancel_receipt_stage": # Callback from InlineKeyboard in admin_settle_...
         # This means admin clicked "لغو ارسال فیش و بازگشت"
@@ -1790,6 +3882,78 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("عملیات تسویه برای این مورد لغو شد و به حالت قبل بازگشت. درخواست همچنان در وضعیت قبلی خود باقی می‌ماند.")
         return
 
+    elif data == "admin_stats_recount":
+        if user_id not in db.get("admins", []):
+            return
+        counters_before = {name: value for name, value in stats_counters().items() if name != "db"}
+        counters_after = recount_stats()
+        drifted = [name for name, value in counters_before.items() if counters_after[name] != value]
+        pending_count = sum(1 for settlement in db.get("settlements", {}).values() if settlement.get("status") == "pending")
+        if count_settlements_with_status("pending") != pending_count:
+            drifted.append("pending_settlements")
+            _db_state["settlement_index"] = None # Rebuilt from the rows on next use
+        if drifted:
+            logging.warning(f"admin_stats_recount: Counters {drifted} had drifted from the data and were corrected.")
+            note = "⚠️ شمارنده‌ها با داده‌ها اختلاف داشتند و اصلاح شدند."
+        else:
+            note = "✅ شمارش کامل با شمارنده‌ها مطابقت داشت."
+        await query.edit_message_text(admin_stats_text(db) + f"\n{note}", parse_mode=ParseMode.MARKDOWN, reply_markup=get_admin_stats_keyboard())
+        return
+
+    elif data.startswith("leaderboard_"):
+        window = data.split("leaderboard_")[1]
+        if window != "all" and window not in LEADERBOARD_WINDOWS:
+            return
+        try:
+            await query.edit_message_text(leaderboard_text(db, window, user_id), reply_markup=get_leaderboard_keyboard(window))
+        except Exception as e: # Same window pressed again: Telegram refuses an unchanged message
+            logging.debug(f"leaderboard: Message not edited: {e}")
+        return
+
+    elif data.startswith("fraud_release_") or data.startswith("fraud_reject_"):
+        if user_id not in db.get("admins", []):
+            await query.answer("❌ شما اجازه انجام این عملیات را ندارید.", show_alert=True)
+            return
+        release = data.startswith("fraud_release_")
+        adder_user_id_str = data.split("_", 2)[2]
+        async with db_transaction(("user", adder_user_id_str)) as db:
+            held_count = len(db.get("held_awards", {}).get(adder_user_id_str, []))
+            if not held_count:
+                await query.edit_message_text(query.message.text + "\n\n✔️ امتیاز نگه‌داشته‌ای برای این کاربر باقی نمانده است (احتمالا قبلا بررسی شده).")
+                return
+            if release:
+                changes, issued = release_held_awards(db, adder_user_id_str)
+                if not changes:
+                    await query.edit_message_text(query.message.text + "\n\n⚠️ این کاربر ثبت‌نام نکرده است؛ امتیازهای نگه‌داشته‌شده حفظ شدند و بعد از ثبت‌نام قابل آزادسازی هستند.")
+                    return
+            else:
+                db["held_awards"].pop(adder_user_id_str, None)
+                changes, issued = [["del", "held_awards", adder_user_id_str]], []
+            commit_db_changes(db, "held_awards_released" if release else "held_awards_rejected", changes)
+        if release:
+            leaderboard()
+            for new_code_id, milestone in issued:
+                queue_code_notification(adder_user_id_str, new_code_id, milestone)
+            note = f"✅ {held_count} امتیاز نگه‌داشته‌شده توسط ادمین {user_id} آزاد شد."
+        else:
+            note = f"❌ {held_count} امتیاز نگه‌داشته‌شده توسط ادمین {user_id} رد شد."
+        logging.info(f"fraud: Admin {user_id} {'released' if release else 'rejected'} {held_count} held awards of user {adder_user_id_str}.")
+        await query.edit_message_text(query.message.text + f"\n\n{note}")
+        return
+
+    elif data == "admin_points_repair":
+        if user_id not in db.get("admins", []):
+            return
+        drifted, issued = reconcile_points(db, recompute=True)
+        save_db(db, (DB_META, "next_code_id")) # reconcile_points marked the rows it changed
+        if drifted or issued:
+            logging.warning(f"admin_points_repair: {len(drifted)} users had drifted from the points ledger; {len(issued)} missing codes were issued.")
+            note = f"⚠️ امتیاز {len(drifted)} کاربر با دفتر امتیاز اختلاف داشت و اصلاح شد. {len(issued)} کد جایزه جاافتاده صادر شد."
+        else:
+            note = "✅ امتیاز همه کاربران با دفتر امتیاز مطابقت داشت."
+        await query.edit_message_text(admin_stats_text(db) + f"\n{note}", parse_mode=ParseMode.MARKDOWN, reply_markup=get_admin_stats_keyboard())
+        return
+
     elif data.startswith("del_promo_link_"):
         if user_id not in db.get("admins", []):
             await query.answer("❌ شما اجازه انجام این عملیات را ندارید.", show_alert=True)
@@ -1798,7 +3962,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             link_index_to_remove = int(data.split("del_promo_link_")[1])
             if 0 <= link_index_to_remove < len(db.get("promotional_links", [])):
                 removed_link = db["promotional_links"].pop(link_index_to_remove)
-                save_db(db)
+                save_db(db, (DB_META, "promotional_links"))
                 await query.edit_message_text(f"✅ لینک '{removed_link}' با موفقیت از لیست حذف شد.")
                 # To refresh the list of links to delete, the admin would click "حذف لینک ❌" again.
             else:
@@ -1831,7 +3995,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if admin_id_to_delete in current_admins:
                 current_admins.remove(admin_id_to_delete)
                 db["admins"] = current_admins # Ensure the list is updated back
-                save_db(db)
+                _admin_profiles.pop(admin_id_to_delete, None)
+                save_db(db, (DB_META, "admins"))
                 await query.edit_message_text(f"✅ ادمین با شناسه `{admin_id_to_delete}` با موفقیت حذف شد.")
             else:
                 await query.answer(f"❌ ادمین با شناسه {admin_id_to_delete} یافت نشد یا قبلا حذف شده.", show_alert=True)
@@ -1957,15 +4122,17 @@ async def admin_typed_support_reply(update: Update, context: ContextTypes.DEFAUL
             await update.message.reply_text(f"⚠️ این تیکت (شماره: {ticket_id_to_reply}) دیگر باز نیست و قبلاً پردازش شده است.", reply_markup=get_admin_keyboard())
         else:
             db["support_tickets"][str(ticket_id_to_reply)]["status"] = "closed"
+            bump_stat("open_tickets", -1)
             db["support_tickets"][str(ticket_id_to_reply)]["response"] = admin_reply_text
             db["support_tickets"][str(ticket_id_to_reply)]["response_date"] = datetime.now().isoformat()
             db["support_tickets"][str(ticket_id_to_reply)]["responded_by"] = update.effective_user.id
-            save_db(db)
+            commit_db_changes(db, "ticket_closed", [["put", "support_tickets", str(ticket_id_to_reply), db["support_tickets"][str(ticket_id_to_reply)]]])
             try:
                 await context.bot.send_message(
                     ticket_info.get("user_id"),
                     f"📬 پاسخ به درخواست پشتیبانی شما (شماره تیکت: `{ticket_id_to_reply}`):\n\n---\n{admin_reply_text}\n---\n\nاین تیکت اکنون بسته شده است. در صورت نیاز به پیگیری بیشتر، لطفاً یک تیکت جدید ایجاد کنید.",
-                    parse_mode=ParseMode.MARKDOWN
+                    parse_mode=ParseMode.MARKDOWN,
+                    rate_limit_args="notification"
                 )
                 await update.message.reply_text(f"✅ پاسخ شما برای تیکت `{ticket_id_to_reply}` با موفقیت ارسال و تیکت بسته شد.", reply_markup=get_admin_keyboard(), parse_mode=ParseMode.MARKDOWN)
             except Exception as e:
@@ -1990,6 +4157,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # User Menu Options
     if text == "امتیازات من 🏆": await show_points(update, context)
     elif text == "کد های من 🎫": await show_codes(update, context)
+    elif text == "برترین‌ها 🥇": await show_leaderboard(update, context)
     elif text == "تسویه حساب 💰": await settlement_menu(update, context)
     elif text == "ارتباط با پشتیبانی 📞": await support_menu(update, context)
     elif text == "راهنما ❓": await show_help(update, context)
@@ -2051,15 +4219,22 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 def main():
     db = init_db()
 
-    app_builder = Application.builder().token(BOT_TOKEN)
-    app_builder.post_init(post_startup_group_check)
+    app_builder = Application.builder().token(BOT_TOKEN).rate_limiter(OutboundScheduler())
+    app_builder.concurrent_updates(KeyedUpdateProcessor())
+    app_builder.post_init(post_init)
+    app_builder.post_stop(post_stop)
+    app_builder.post_shutdown(flush_db_on_shutdown)
     app = app_builder.build()
 
     if app.job_queue:
         app.job_queue.run_repeating(periodic_group_check, interval=3600, first=120)
         logging.info("Periodic group check job scheduled.")
+        app.job_queue.run_repeating(db_write_behind_job, interval=DB_FLUSH_INTERVAL, first=DB_FLUSH_INTERVAL)
+        _db_state["write_behind"] = True
+        logging.info(f"Database write-behind job scheduled every {DB_FLUSH_INTERVAL}s.")
     else:
         logging.warning("Job Queue not available. Periodic tasks will not run automatically.")
+        logging.warning("Database writes will go straight to disk (no write-behind).")
 
     registration_conv = ConversationHandler(
         entry_points=[CommandHandler("start", start, filters.ChatType.PRIVATE)],
@@ -2163,6 +4338,7 @@ def main():
     )
 
     # Add conversation handlers first, as they are more specific.
+    app.add_handler(TypeHandler(Update, refresh_admin_profile_from_update), group=-1)
     app.add_handler(registration_conv)
     app.add_handler(edit_conv)
     app.add_handler(support_conv)
@@ -2180,6 +4356,7 @@ def main():
 
     # Chat Member Handlers
     app.add_handler(ChatMemberHandler(unified_bot_status_handler, ChatMemberHandler.MY_CHAT_MEMBER))
+    app.add_handler(ChatMemberHandler(track_channel_membership, ChatMemberHandler.CHAT_MEMBER))
     app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS & filters.ChatType.GROUPS, track_new_member))
     app.add_handler(MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER & filters.ChatType.GROUPS, track_left_member))
 
@@ -2189,8 +4366,24 @@ def main():
     # Error Handler (should be last)
     app.add_error_handler(error_handler)
 
-    logging.info("Bot starting to poll...")
-    app.run_polling(allowed_updates=Update.ALL_TYPES, timeout=30)
+    if RUN_MODE == "webhook":
+        secret_token = WEBHOOK_SECRET_TOKEN
+        if not secret_token:
+            secret_token = secrets.token_urlsafe(32)
+            logging.warning("WEBHOOK_SECRET_TOKEN is not set; using a random secret for this run.")
+        logging.info(f"Bot starting webhook listener on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH} for {WEBHOOK_URL}...")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=secret_token,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        logging.info("Bot starting to poll...")
+        app.run_polling(allowed_updates=Update.ALL_TYPES, timeout=30)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,39 @@
+import sys
+import types
+from pathlib import Path
+
+import pytest
+
+BOT_SOURCE = Path(__file__).resolve().parent.parent / "CheckStatBot.py"
+
+# The bot is configured by editing the constants at the top of CheckStatBot.py; the shipped
+# placeholders do not evaluate, so the tests fill them in before importing
+PLACEHOLDERS = {
+    'ADMIN_ID = "Your-User-Id"': 'ADMIN_ID = 1',
+    'CHANNEL_ID = -"Your-Channel-iD"': 'CHANNEL_ID = -100',
+}
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    """A freshly imported CheckStatBot module whose bot_database directory lives in tmp_path."""
+    source = BOT_SOURCE.read_text(encoding="utf-8")
+    for placeholder, value in PLACEHOLDERS.items():
+        source = source.replace(placeholder, value)
+    monkeypatch.chdir(tmp_path)
+    module = types.ModuleType("CheckStatBot")
+    module.__file__ = str(BOT_SOURCE)
+    monkeypatch.setitem(sys.modules, "CheckStatBot", module)
+    exec(compile(source, str(BOT_SOURCE), "exec"), module.__dict__)
+    yield module
+    module._db_executor.shutdown(wait=True)
+    if module._db_state["journal"] is not None:
+        module._db_state["journal"].close()
+
+
+def restart(bot):
+    """Drops the resident database, as a restart would, and loads it again from disk."""
+    if bot._db_state["journal"] is not None:
+        bot._db_state["journal"].close()
+    bot._db_state.update(data=None, storage=None, journal=None, journal_bytes=0, journal_since=None, journal_keys={})
+    return bot.load_db()
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+from conftest import restart
+
+
+@pytest.fixture
+def journaled(bot):
+    bot.DB_JOURNAL_ENABLED = True
+    db = bot.load_db()
+    db["groups"]["-5"] = {"title": "Group", "members": set()}
+    bot.save_db(db, "groups")
+    return bot, db
+
+
+def shard_contents(bot):
+    contents = {}
+    for name in os.listdir(bot.DB_DIR):
+        if name.endswith(".json"):
+            with open(os.path.join(bot.DB_DIR, name), encoding="utf-8") as f:
+                contents[name] = f.read()
+    return contents
+
+
+def test_unflushed_records_are_replayed_after_a_crash(journaled):
+    bot, db = journaled
+    db["users"]["7"] = {"registered": True, "points": 0, "codes": [], "name": "Sara"}
+    db["groups"]["-5"]["members"].add(11)
+    bot.commit_db_changes(db, "test", [["put", "users", "7", db["users"]["7"]], ["member_add", "-5", 11]])
+    db["users"]["7"]["name"] = "Sara K."
+    bot.commit_db_changes(db, "test", [["put", "users", "7", db["users"]["7"]]])
+    assert os.path.exists(bot.DB_JOURNAL_FILE)
+
+    reloaded = restart(bot) # No flush: the snapshot never saw these changes
+    assert reloaded["users"]["7"]["name"] == "Sara K."
+    assert reloaded["groups"]["-5"]["members"] == {11}
+
+
+def test_torn_last_record_is_ignored(journaled):
+    bot, db = journaled
+    db["users"]["7"] = {"registered": True, "points": 0, "codes": []}
+    bot.commit_db_changes(db, "test", [["put", "users", "7", db["users"]["7"]]])
+    bot._db_state["journal"].close()
+    bot._db_state["journal"] = None
+    with open(bot.DB_JOURNAL_FILE, "a", encoding="utf-8") as f:
+        f.write('{"op": "test", "changes": [["put", "users", "8"') # Crash mid-append
+
+    reloaded = restart(bot)
+    assert "7" in reloaded["users"]
+    assert "8" not in reloaded["users"]
+
+
+def test_row_level_saves_are_journaled_without_rewriting_shards(journaled):
+    bot, db = journaled
+    db["users"]["8"] = {"registered": True, "points": 0, "codes": [], "name": "Reza"}
+    bot.commit_db_changes(db, "test", [["put", "users", "8", db["users"]["8"]], ["member_add", "-5", 12]])
+    before = shard_contents(bot)
+
+    db["users"]["8"]["name"] = "Reza M."
+    bot.save_db(db, ("users", "8"))
+    db["admins"].append(9)
+    bot.save_db(db, (bot.DB_META, "admins"))
+
+    assert shard_contents(bot) == before
+    reloaded = restart(bot)
+    assert reloaded["users"]["8"]["name"] == "Reza M."
+    assert 9 in reloaded["admins"]
+
+
+def test_compaction_folds_the_journal_into_the_shards(journaled):
+    bot, db = journaled
+    db["users"]["7"] = {"registered": True, "points": 0, "codes": []}
+    db["groups"]["-5"]["members"].add(11)
+    bot.commit_db_changes(db, "test", [["put", "users", "7", db["users"]["7"]], ["member_add", "-5", 11]])
+    db["users"].pop("7")
+    bot.commit_db_changes(db, "test", [["del", "users", "7"]])
+
+    bot.flush_db(compact_journal=True)
+    assert bot.journal_segments() == []
+    reloaded = restart(bot)
+    assert "7" not in reloaded["users"]
+    assert reloaded["groups"]["-5"]["members"] == {11}
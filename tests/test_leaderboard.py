@@ -0,0 +1,62 @@
+import random
+
+DAY = 24 * 3600
+NOW = 1_800_000_000
+
+
+def brute_force_ranking(scores):
+    ranked = sorted(((user_id, score) for user_id, score in scores.items() if score > 0), key=lambda row: (-row[1], row[0]))
+    ranks = {user_id: 1 + sum(1 for other in scores.values() if other > score) for user_id, score in ranked}
+    return ranked, ranks
+
+
+def test_score_rank_matches_brute_force(bot):
+    rng = random.Random(24)
+    rank, scores = bot.ScoreRank(size=8), {} # A small tree so _grow() gets exercised too
+    for _ in range(3000):
+        user_id = rng.randint(1, 60)
+        delta = rng.choice([1, 1, 1, 2, 5, 40, -1, -3])
+        delta = max(delta, -scores.get(user_id, 0)) # Scores never go below zero, as with ledger deltas
+        rank.update(user_id, delta)
+        scores[user_id] = scores.get(user_id, 0) + delta
+
+        if rng.random() < 0.05:
+            ranked, ranks = brute_force_ranking(scores)
+            assert len(rank) == len(ranked)
+            assert rank.top(10) == ranked[:10]
+            assert rank.top(len(ranked) + 5) == ranked
+            for user_id, score in scores.items():
+                assert rank.score(user_id) == score
+                assert rank.rank(user_id) == ranks.get(user_id)
+
+
+def test_windows_drop_entries_as_they_age(bot):
+    db = bot.load_db()
+    ledger = db["points_ledger"]
+    ledger.append(7, 11, -5, 1, NOW - 10 * DAY)
+    ledger.append(7, 12, -5, 1, NOW - 2 * DAY)
+    ledger.append(8, 13, -5, 1, NOW - 3600)
+
+    ranks = bot.leaderboard(NOW)
+    assert {window: ranks[window].score(7) for window in ranks} == {"all": 2, "day": 0, "week": 1, "month": 2}
+    assert ranks["day"].top(5) == [(8, 1)]
+
+    ranks = bot.leaderboard(NOW + DAY)
+    assert ranks["day"].score(8) == 0
+    assert ranks["all"].score(8) == 1
+
+
+def test_late_entries_outside_a_window_are_never_counted_in_it(bot):
+    db = bot.load_db()
+    ledger = db["points_ledger"]
+    ledger.append(8, 13, -5, 1, NOW - 60)
+    bot.leaderboard(NOW)
+    ledger.append(7, 11, -5, 1, NOW - 2 * DAY) # A held award released two days after the join
+
+    ranks = bot.leaderboard(NOW)
+    assert ranks["day"].score(7) == 0
+    assert ranks["week"].score(7) == 1
+    ranks = bot.leaderboard(NOW + 2 * DAY)
+    assert ranks["day"].score(7) == 0
+    assert ranks["day"].score(8) == 0
+    assert ranks["week"].score(7) == 1
@@ -0,0 +1,57 @@
+import sqlite3
+
+from conftest import restart
+
+
+def test_round_trip_keeps_every_collection(bot):
+    bot.STORAGE_ENGINE = "sqlite"
+    db = bot.load_db()
+    db["users"]["7"] = {"registered": True, "points": 2, "codes": [], "name": "Sara"}
+    db["groups"]["-5"] = {"title": "Group", "members": {11, 12}}
+    db["unique_members"].add("11", {"first_added_by": 7, "first_group_id": "-5", "first_added_date": "2026-01-01T10:00:00"})
+    db["points_ledger"].append(7, 11, -5, 1, 1_700_000_000)
+    db["points_ledger"].append(7, 12, -5, 1, 1_700_000_100)
+    db["promotional_links"] = ["https://t.me/example"]
+    bot.save_db(db)
+
+    reloaded = restart(bot)
+    assert reloaded["users"]["7"] == db["users"]["7"]
+    assert reloaded["groups"]["-5"] == {"title": "Group", "members": {11, 12}}
+    assert reloaded["unique_members"].get("11")["first_added_by"] == 7
+    assert [reloaded["points_ledger"].entry(seq) for seq in range(len(reloaded["points_ledger"]))] == \
+        [db["points_ledger"].entry(seq) for seq in range(len(db["points_ledger"]))]
+    assert reloaded["promotional_links"] == ["https://t.me/example"]
+
+
+def test_row_level_saves_upsert_and_delete_single_rows(bot):
+    bot.STORAGE_ENGINE = "sqlite"
+    db = bot.load_db()
+    db["users"]["7"] = {"registered": True, "points": 0, "codes": [], "name": "Sara"}
+    db["users"]["8"] = {"registered": True, "points": 0, "codes": [], "name": "Reza"}
+    bot.save_db(db, "users")
+
+    db["users"]["7"]["name"] = "Sara K."
+    db["users"].pop("8")
+    bot.save_db(db, ("users", "7"), ("users", "8"))
+    db["next_ticket_id"] = 42
+    bot.save_db(db, (bot.DB_META, "next_ticket_id"))
+
+    reloaded = restart(bot)
+    assert reloaded["users"]["7"]["name"] == "Sara K."
+    assert "8" not in reloaded["users"]
+    assert reloaded["next_ticket_id"] == 42
+
+
+def test_indexed_columns_follow_the_row(bot):
+    bot.STORAGE_ENGINE = "sqlite"
+    db = bot.load_db()
+    db["users"]["7"] = {"registered": True, "points": 0, "codes": []}
+    bot.save_db(db, ("users", "7"))
+    db["users"]["7"]["points"] = 5
+    bot.save_db(db, ("users", "7"))
+
+    conn = sqlite3.connect(bot.SQLITE_DB_FILE)
+    try:
+        assert conn.execute("SELECT registered, points FROM users WHERE key = '7'").fetchone() == (1, 5)
+    finally:
+        conn.close()
@@ -0,0 +1,55 @@
+from conftest import restart
+
+
+def open_ticket(bot, db, ticket_id):
+    # Same order as handle_support_message: the row is written before the counter is bumped
+    db["support_tickets"][ticket_id] = {"user_id": 7, "message": "help", "status": "open"}
+    bot.bump_stat("open_tickets")
+
+
+def close_ticket(bot, db, ticket_id):
+    # Same order as admin_typed_support_reply
+    db["support_tickets"][ticket_id]["status"] = "closed"
+    bot.bump_stat("open_tickets", -1)
+
+
+def test_first_ticket_after_start_up_is_counted_once(bot):
+    db = bot.load_db()
+    open_ticket(bot, db, "1")
+    assert bot.stats_counters()["open_tickets"] == 1
+    close_ticket(bot, db, "1")
+    assert bot.stats_counters()["open_tickets"] == 0
+
+
+def test_counters_are_rebuilt_from_the_reloaded_rows(bot):
+    db = bot.load_db()
+    db["users"]["7"] = {"registered": True, "points": 0, "codes": []}
+    db["users"]["8"] = {"registered": False, "points": 0, "codes": []}
+    db["support_tickets"]["1"] = {"user_id": 7, "status": "open"}
+    bot.save_db(db)
+
+    db = restart(bot)
+    registered = sum(1 for user_data in db["users"].values() if user_data.get("registered"))
+    assert bot.stats_counters()["registered_users"] == registered
+    open_ticket(bot, db, "2")
+    assert bot.stats_counters()["open_tickets"] == 2
+
+
+def test_bumps_match_a_full_recount(bot):
+    db = bot.load_db()
+    for ticket_id in map(str, range(1, 6)):
+        open_ticket(bot, db, ticket_id)
+    close_ticket(bot, db, "2")
+    close_ticket(bot, db, "4")
+    counted = {name: value for name, value in bot.stats_counters().items() if name != "db"}
+    recounted = {name: value for name, value in bot.recount_stats().items() if name != "db"}
+    assert counted == recounted == {**counted, "open_tickets": 3}
+
+
+def test_recount_keeps_the_settlement_index_and_leaderboard(bot):
+    bot.load_db()
+    index = bot.settlement_index()
+    board = bot.leaderboard()
+    bot.recount_stats()
+    assert bot.settlement_index() is index
+    assert bot.leaderboard() is board
@@ -0,0 +1,90 @@
+import asyncio
+import random
+from datetime import datetime, timezone
+
+from telegram import Chat, Message, Update, User
+
+
+def make_update(update_id, user_id, chat_id):
+    user = User(id=user_id, first_name=f"user{user_id}", is_bot=False)
+    chat = Chat(id=chat_id, type=Chat.PRIVATE if chat_id == user_id else Chat.SUPERGROUP)
+    message = Message(message_id=update_id, date=datetime.now(timezone.utc), chat=chat, from_user=user, text="hi")
+    return Update(update_id=update_id, message=message)
+
+
+async def process_all(processor, updates, handle):
+    await asyncio.gather(*(processor.process_update(update, handle(update)) for update in updates))
+
+
+def test_updates_sharing_a_user_or_chat_run_in_arrival_order(bot):
+    rng = random.Random(7)
+    updates = []
+    for update_id in range(200):
+        # Users 1-4 write in their private chats and in two shared groups
+        user_id = rng.randint(1, 4)
+        updates.append(make_update(update_id, user_id, rng.choice([-10, -20, user_id])))
+    started, finished = [], []
+
+    async def handle(update):
+        started.append(update.update_id)
+        await asyncio.sleep(rng.random() / 500)
+        finished.append(update.update_id)
+
+    asyncio.run(process_all(bot.KeyedUpdateProcessor(max_concurrent_updates=16), updates, handle))
+
+    assert sorted(finished) == list(range(200))
+    for update in updates:
+        keys = bot.KeyedUpdateProcessor.update_keys(update)
+        earlier = [other.update_id for other in updates[:update.update_id] if keys & bot.KeyedUpdateProcessor.update_keys(other)]
+        # Every earlier update sharing a key had finished before this one started
+        assert all(finished.index(other) < started.index(update.update_id) for other in earlier)
+
+
+def test_unrelated_updates_run_concurrently(bot):
+    running, peak = 0, 0
+
+    async def handle(update):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    updates = [make_update(i, 100 + i, 100 + i) for i in range(8)]
+    asyncio.run(process_all(bot.KeyedUpdateProcessor(max_concurrent_updates=4), updates, handle))
+    assert peak == 4
+
+
+def test_cancelled_waiter_does_not_let_its_successor_overtake(bot):
+    order = []
+
+    async def scenario():
+        processor = bot.KeyedUpdateProcessor(max_concurrent_updates=4)
+        gate = asyncio.Event()
+
+        async def slow(update):
+            await gate.wait()
+            order.append(update.update_id)
+
+        async def fast(update):
+            order.append(update.update_id)
+
+        def submit(update_id, handle):
+            update = make_update(update_id, 5, 5)
+            return asyncio.ensure_future(processor.process_update(update, handle(update)))
+
+        first = submit(1, slow)
+        await asyncio.sleep(0)
+        second = submit(2, fast)
+        await asyncio.sleep(0)
+        third = submit(3, fast)
+        await asyncio.sleep(0.01)
+        second.cancel()
+        await asyncio.sleep(0.01)
+        assert order == [] # The third update still waits for the first
+        gate.set()
+        await asyncio.gather(first, third)
+        await asyncio.gather(second, return_exceptions=True)
+
+    asyncio.run(scenario())
+    assert order == [1, 3]